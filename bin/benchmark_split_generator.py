@@ -0,0 +1,247 @@
+''' Benchmark gen1_split_generator against synthetic data
+    Synthetic split_halves payloads and input lists are served by local
+    stand-ins for the config, SAGE and FlyCore responders, so this runs
+    offline. Each size is run in a separate process, and throughput, peak
+    memory and per-phase times are reported.
+'''
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+import colorlog
+
+# Synthetic data
+SCORE = {'AE_01': 3.5, 'AV_01': 2, 'BB_21': 3.5, 'BC_21': 1.5, 'AE_02': 3, 'BB_02': 1}
+SUFFIXES = {'AD': ['AE_01', 'AV_01', 'AE_02'], 'DBD': ['BB_21', 'BC_21', 'BB_02']}
+DATA = {'halves': {}, 'lines': [], 'vt': {}}
+PHASES = ('config', 'split_halves', 'vt_conversion', 'line_search', 'flycore', 'scoring',
+          'output')
+
+# pylint: disable=W0703
+
+# -----------------------------------------------------------------------------
+
+def synthetic_halves(size, halves, seed):
+    """ Generate a synthetic split_halves payload
+        Keyword arguments:
+          size: number of fragments
+          halves: mean number of halves per fragment
+          seed: random seed
+        Returns:
+          None (DATA is populated)
+    """
+    rnd = random.Random(seed)
+    DATA['halves'] = {}
+    DATA['lines'] = []
+    DATA['vt'] = {}
+    for num in rnd.sample(range(140 * 96), size):
+        plate = num // 96 + 1
+        frag = ('GMR_' if plate < 100 else 'BJD_') + '%d%s%02d' \
+               % (plate, 'ABCDEFGH'[num % 96 // 12], num % 12 + 1)
+        DATA['halves'][frag] = []
+        for _ in range(max(1, int(rnd.expovariate(1.0 / halves) + 0.5))):
+            dtype = rnd.choice(['AD', 'DBD'])
+            line = frag + '_' + rnd.choice(SUFFIXES[dtype])
+            if any(half['line'] == line for half in DATA['halves'][frag]):
+                continue
+            DATA['halves'][frag].append({'line': line, 'type': dtype,
+                                         'driver': 'GAL4' if rnd.random() < 0.95 else 'LexA'})
+            DATA['lines'].append(line)
+    for idx, frag in enumerate(sorted(DATA['halves'])[:max(1, size // 20)]):
+        DATA['vt']['VT%06d' % (idx + 1)] = DATA['halves'][frag][0]['line']
+
+
+def input_list(seed):
+    """ Generate an input list of fragments, lines and VT numbers
+        Keyword arguments:
+          seed: random seed
+        Returns:
+          list of search terms
+    """
+    rnd = random.Random(seed)
+    vtfrags = {line.rsplit('_', 2)[0] for line in DATA['vt'].values()}
+    terms = list(DATA['vt'])
+    for frag, halves in DATA['halves'].items():
+        if frag in vtfrags:
+            continue
+        choice = rnd.random()
+        if choice < 0.5:
+            terms.append(frag.split('_')[1])
+        elif choice < 0.8:
+            terms.append(frag)
+        else:
+            terms.append(halves[0]['line'])
+    rnd.shuffle(terms)
+    return(terms)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Stand-in for the config, SAGE and FlyCore responders
+        Requests arrive as a proxy would receive them, so the responder is
+        identified by the host name in the URL.
+    """
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply(200, {'rest': {}})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server = url.netloc.split('.')[0]
+        query = parse_qs(url.query)
+        if server == 'config':
+            return self.config_response(url.path)
+        if server == 'sage':
+            return self.sage_response(url.path, query)
+        if server == 'flycore':
+            line = query['line'][0]
+            return self.reply(200, {'linedata': {
+                'A_Concat_Loc': 'R%d' % (len(line)), '__kp_UniqueID': str(sum(map(ord, line))),
+                'RobotID': str(len(line) * 7), 'Genotype_GSI_Name_PlateWell': line,
+                'Chromosome': '3', 'fragment': line.split('_')[1],
+                'Production_Info': 'Benchmark', 'Quality_Control': ''}})
+        return self.reply(404, {})
+
+    def config_response(self, path):
+        if path == '/config/rest_services':
+            return self.reply(200, {'config': {'config': {'url': 'http://config.benchmark/'},
+                                               'sage': {'url': 'http://sage.benchmark/'},
+                                               'flycore': {'url': 'http://flycore.benchmark/'}}})
+        if path == '/config/gen1_split_generator':
+            return self.reply(200, {'config': {'score': SCORE}})
+        if path == '/config/vt_conversion':
+            return self.reply(200, {'config': {}})
+        return self.reply(404, {})
+
+    def sage_response(self, path, query):
+        if path == '/split_halves':
+            return self.reply(200, {'split_halves': DATA['halves']})
+        if path.startswith('/translatevt/'):
+            vtn = path.split('/')[-1]
+            return self.reply(200, {'line_data': [{'line': DATA['vt'][vtn]}]
+                                                 if vtn in DATA['vt'] else []})
+        if path == '/lines':
+            name = unquote(query['name'][0])
+            term = name.replace('*', '').replace('\\', '')
+            return self.reply(200, {'line_data': [{'name': line} for line in DATA['lines']
+                                                  if term in line]})
+        return self.reply(404, {})
+
+
+def run_size(size, port):
+    """ Run gen1_split_generator for one size
+        Keyword arguments:
+          size: number of fragments
+          port: stand-in server port
+        Returns:
+          result dictionary
+    """
+    synthetic_halves(size, ARG.HALVES, ARG.SEED)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, 'order.txt'), 'w') as ofile:
+            ofile.write("\n".join(input_list(ARG.SEED)) + "\n")
+        env = dict(os.environ, HOME=tmpdir, NO_PROXY='', no_proxy='',
+                   HTTP_PROXY='http://127.0.0.1:%d' % (port),
+                   http_proxy='http://127.0.0.1:%d' % (port))
+        command = [sys.executable, ARG.SCRIPT, '--file', 'order.txt', '--name', 'benchmark',
+                   '--report', 'report.json', '--workers', str(ARG.WORKERS)]
+        if ARG.ALL:
+            command.append('--all')
+        with open(os.path.join(tmpdir, 'stderr.txt'), 'w+') as errfile:
+            proc = subprocess.Popen(command, cwd=tmpdir, env=env,
+                                    stdout=subprocess.DEVNULL, stderr=errfile)
+            # wait4 returns resource usage for this child alone
+            (_, status, usage) = os.wait4(proc.pid, 0)
+            if status:
+                errfile.seek(0)
+                LOGGER.error("Run with %d fragments failed:\n%s", size, errfile.read())
+                return None
+        with open(os.path.join(tmpdir, 'report.json')) as rfile:
+            report = json.load(rfile)
+    report['fragments'] = size
+    report['halves'] = len(DATA['lines'])
+    # ru_maxrss is in kilobytes on Linux
+    report['peak_memory_mb'] = usage.ru_maxrss / 1024.0
+    return(report)
+
+
+def run_benchmarks():
+    """ Run benchmarks for all sizes and report the results
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    results = []
+    print("%9s %7s %10s %12s %10s  %s" % ('Fragments', 'Halves', 'Pairs', 'Pairs/sec',
+                                         'Peak MB', ' '.join('%12s' % p for p in PHASES)))
+    for size in [int(size) for size in ARG.SIZES.split(',')]:
+        result = run_size(size, server.server_address[1])
+        if not result:
+            continue
+        results.append(result)
+        print("%9d %7d %10d %12.0f %10.1f  %s"
+              % (size, result['halves'], result['counters'].get('pairs', 0),
+                 result['counters'].get('pairs_per_second', 0), result['peak_memory_mb'],
+                 ' '.join('%12.3f' % result['phases'].get(phase, {}).get('seconds', 0)
+                          for phase in PHASES)))
+    server.shutdown()
+    if ARG.OUTPUT:
+        with open(ARG.OUTPUT, 'w') as ofile:
+            json.dump(results, ofile, indent=2)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark gen1_split_generator against synthetic data")
+    PARSER.add_argument('--sizes', dest='SIZES', action='store', default='100,1000,5000',
+                        help='Comma-separated fragment counts')
+    PARSER.add_argument('--halves', dest='HALVES', action='store', type=float, default=3,
+                        help='Mean number of split halves per fragment')
+    PARSER.add_argument('--all', dest='ALL', action='store_true', default=False,
+                        help='Output all cross combinations')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int, default=1,
+                        help='Number of processes to generate crosses with')
+    PARSER.add_argument('--seed', dest='SEED', action='store', type=int, default=1,
+                        help='Random seed')
+    PARSER.add_argument('--script', dest='SCRIPT', action='store',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'gen1_split_generator.py'),
+                        help='Split generator script')
+    PARSER.add_argument('--output', dest='OUTPUT', action='store', default='',
+                        help='JSON file for results')
+    PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
+                        default=False, help='Flag, Chatty')
+    PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
+                        default=False, help='Flag, Very chatty')
+    ARG = PARSER.parse_args()
+
+    LOGGER = colorlog.getLogger()
+    if ARG.DEBUG:
+        LOGGER.setLevel(colorlog.colorlog.logging.DEBUG)
+    elif ARG.VERBOSE:
+        LOGGER.setLevel(colorlog.colorlog.logging.INFO)
+    else:
+        LOGGER.setLevel(colorlog.colorlog.logging.WARNING)
+    HANDLER = colorlog.StreamHandler()
+    HANDLER.setFormatter(colorlog.ColoredFormatter())
+    LOGGER.addHandler(HANDLER)
+    run_benchmarks()
+    sys.exit(0)
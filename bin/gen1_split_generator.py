@@ -1,26 +1,159 @@
 #!/usr/bin/env python
 import argparse
+import bisect
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import gzip
+import heapq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
 import json
+import multiprocessing
 import os
 from os.path import expanduser
 import pwd
 import re
 import select
 import sys
+import tempfile
+import threading
+import time
 import colorlog
 import requests
+import numpy as np
 
 
 # Configuration
 SUFFIX_SCORE = {}
 CONFIG = {'config': {'url': 'http://config.int.janelia.org/'}}
-VTCACHE = {}
+VTCACHE = None
+VTMISSING = set()
 WARNED = {}
 fcdict = dict()
+RESPONDER_THREADS = 8
+# Profiling
+PROFILE = {'phases': {}, 'responders': {}, 'counters': {}}
+PROFILE_LOCK = threading.Lock()
+# Cross scoring
+LANDING_SITE = {}
+CROSS_BLOCK = 4096
+SHARED = ()
+PREVIOUS = {}
+# Line names
+LINE_CACHE = {}
+GEN1_LINE = re.compile('^((BJD|GMR)_)*[0-9]+[A-H][0-9]{2}_[A-Z]{2}_[0-9]{2}$', re.IGNORECASE)
+GEN1_FRAGMENT = re.compile('^((BJD|GMR)_)*[0-9]+[A-H][0-9]{2}$', re.IGNORECASE)
+GEN1_PREFIX = re.compile('^((BJD|GMR)_)')
+GEN1_SUFFIX = re.compile('_[A-Z][A-Z]_[0-9][0-9]')
+PLATE_NUMBER = re.compile('[0-9]+')
+# Service
+FRAGINDEX = None
+ORDER_LOCK = threading.Lock()
+ORDER_BUFFER = 1 << 20
+SERVICE_ARG = None
+SERVICE_STATUS = {'refreshed': ''}
+# Output
+FCFIELDS = {}
+WRITE_BATCH = 10000
+CROSS_ROW = "%s-x-%s\n"
+FLYCORE_COLUMNS = ('Who', '#', 'Alias', 'Pfrag', 'IS')
+STOCK_COLUMNS = ('__flipper_flystocks_stock::RACK_LOCATION',
+                 'StockFinder::__kp_UniqueID', 'StockFinder::RobotID',
+                 'StockFinder::Genotype_GSI_Name_PlateWell',
+                 'StockFinder::Chromosome', 'StockFinder::Stock_Name',
+                 'StockFinder::fragment', 'StockFinder::Production_Info',
+                 'StockFinder::Quality_Control')
+FLYCORE_ROW = '\t'.join(['%s'] * (len(FLYCORE_COLUMNS) + 2 * len(STOCK_COLUMNS))) + '\n'
+HALVES_CACHE = expanduser('~/.cache/gen1_split_generator/split_halves.npy')
+
+def add_time(group, name, elapsed):
+    """ Add elapsed time to a profile counter
+        Keyword arguments:
+          group: "phases" or "responders"
+          name: phase or responder name
+          elapsed: seconds
+        Returns:
+          None
+    """
+    with PROFILE_LOCK:
+        rec = PROFILE[group].setdefault(name, {'calls': 0, 'seconds': 0.0})
+        rec['calls'] += 1
+        rec['seconds'] += elapsed
+
+
+def record_time(group, name, start):
+    """ Add the time since start to a profile counter
+        Keyword arguments:
+          group: "phases" or "responders"
+          name: phase or responder name
+          start: perf_counter start time
+        Returns:
+          None
+    """
+    add_time(group, name, time.perf_counter() - start)
+
+
+def phase_seconds(name):
+    """ Return the time recorded so far for a phase
+    """
+    with PROFILE_LOCK:
+        return(PROFILE['phases'].get(name, {}).get('seconds', 0.0))
+
+
+@contextmanager
+def timed(name):
+    """ Time a phase of the run
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time('phases', name, start)
+
+
+def timed_iter(name, iterable):
+    """ Iterate, timing only the time spent producing items as a phase
+        Keyword arguments:
+          name: phase name
+          iterable: iterable to time
+        Returns:
+          iterator over the items
+    """
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        add_time('phases', name, elapsed)
+
+
+def write_profile():
+    """ Write the profile as a JSON report (--report) or to STDERR (--profile)
+    """
+    scoring = phase_seconds('scoring')
+    if scoring:
+        PROFILE['counters']['pairs_per_second'] = PROFILE['counters'].get('pairs', 0) / scoring
+    if ARG.REPORT:
+        with open(ARG.REPORT, 'w') as rfile:
+            json.dump(PROFILE, rfile, indent=2)
+    if ARG.PROFILE:
+        json.dump(PROFILE, sys.stderr, indent=2)
+        sys.stderr.write("\n")
+
 
 def call_responder(server, endpoint, post=''):
     url = CONFIG[server]['url'] + endpoint
+    start = time.perf_counter()
     try:
         if post:
             req = requests.post(url, post)
@@ -29,6 +162,8 @@ def call_responder(server, endpoint, post=''):
     except requests.exceptions.RequestException as err:
         logger.critical(err)
         sys.exit(-1)
+    finally:
+        record_time('responders', server, start)
     if req.status_code == 200:
         return req.json()
     elif req.status_code == 404:
@@ -41,6 +176,38 @@ def call_responder(server, endpoint, post=''):
         sys.exit(-1)
 
 
+def call_concurrently(func, items):
+    """ Call a function for each item with a bounded pool of threads
+        A responder failure (sys.exit) in any call is raised as soon as it
+        happens, and calls that have not started are cancelled.
+        Keyword arguments:
+          func: function to call
+          items: list of arguments
+        Returns:
+          list of results, in item order
+    """
+    executor = ThreadPoolExecutor(max_workers=RESPONDER_THREADS)
+    futures = [executor.submit(func, item) for item in items]
+    try:
+        for future in as_completed(futures):
+            future.result()
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+    return([future.result() for future in futures])
+
+
+def open_output(name):
+    """ Open an output file, compressed with gzip if --compress is specified
+    """
+    if ARG.COMPRESS:
+        return(gzip.open(name + '.gz', 'wt'))
+    return(open(name, 'w'))
+
+
 def find_username(userid):
     if not userid:
         userid = pwd.getpwuid(os.getuid())[0]
@@ -64,28 +231,83 @@ def initialize_program(name):
     logger.info("Will use name " + ORDERNAME + " on output spreadsheet")
 
 
+class LineName:
+    """ Parsed form of a line name or search term
+        kind is "vt", "gen1" (split half line), "fragment" (Gen1 fragment)
+        or "other". The suffix score is only looked up when it is first used.
+    """
+    __slots__ = ('kind', 'platewell', 'suffix', 'site', '_score')
+
+    def __init__(self, name):
+        if name.upper().startswith('VT') or name.isdigit():
+            self.kind = 'vt'
+        elif GEN1_LINE.match(name):
+            self.kind = 'gen1'
+        elif GEN1_FRAGMENT.match(name):
+            self.kind = 'fragment'
+        else:
+            self.kind = 'other'
+        platewell = name.upper()
+        if GEN1_PREFIX.match(platewell):
+            platewell = platewell.split('_')[1]
+        self.platewell = platewell.partition('_')[0]
+        self.suffix = '_'.join(name.rsplit('_', 2)[-2:]) if self.kind == 'gen1' else ''
+        self.site = landing_site_code(name)
+        self._score = None
+
+    @property
+    def score(self):
+        if self._score is None:
+            self._score = suffix_score(self.suffix) if self.kind == 'gen1' else 1
+        return(self._score)
+
+
+def classify_line(name):
+    """ Return the (memoized) parsed form of a line name
+        Keyword arguments:
+          name: line name or search term
+        Returns:
+          LineName
+    """
+    if name not in LINE_CACHE:
+        LINE_CACHE[name] = LineName(name)
+    return(LINE_CACHE[name])
+
+
+def classify_lines(names):
+    """ Return the parsed forms of a list of line names
+        Keyword arguments:
+          names: list of line names or search terms
+        Returns:
+          list of LineName
+    """
+    return([LINE_CACHE[name] if name in LINE_CACHE else classify_line(name)
+            for name in names])
+
+
 def is_vt(line):
-    if line.upper().startswith('VT'):
-        return(1)
-    return(1 if line.isdigit() else 0)
+    return(1 if classify_line(line).kind == 'vt' else 0)
 
 
 def is_gen1(line):
-    m = re.search('^((BJD|GMR)_)*[0-9]+[A-H][0-9]{2}_[A-Z]{2}_[0-9]{2}$', line, re.IGNORECASE)
-    return(1 if m else 0)
+    return(1 if classify_line(line).kind == 'gen1' else 0)
 
 
 def is_gen1_fragment(line):
-    m = re.search('^((BJD|GMR)_)*[0-9]+[A-H][0-9]{2}$', line, re.IGNORECASE)
-    return(1 if m else 0)
+    return(1 if classify_line(line).kind == 'fragment' else 0)
 
 
 def convert_gen1(gen1):
-	gen1 = gen1.upper()
-	if re.search('^((BJD|GMR)_)', gen1):
-		gen1 = gen1.split('_' )[1]
-	gen1 = re.sub('_.*', '', gen1)
-	return(gen1)
+    return(classify_line(gen1).platewell)
+
+
+def load_vt_cache():
+    """ Get cached VT conversions from the config server
+    """
+    global VTCACHE  # pylint: disable=W0603
+    response = call_responder('config', 'config/vt_conversion')
+    VTCACHE = response['config']
+    logger.info("Found %s entries in VT cache", len(VTCACHE))
 
 
 def translate_vt(vt):
@@ -101,86 +323,325 @@ def translate_vt(vt):
         return('')
 
 
-def convert_vt(search_term):
+def translate_vts(vts):
+    """ Translate VT numbers that are not in the VT cache
+        Lookups run concurrently, and each new conversion is written back to
+        the config server as it is found.
+        Keyword arguments:
+          vts: list of VT numbers ("VT012345")
+        Returns:
+          None
+    """
+    missing = sorted(set(vts).difference(VTCACHE, VTMISSING))
+    if not missing:
+        return
+    logger.info("Translating %d VT numbers", len(missing))
+    for vt, line in zip(missing, call_concurrently(translate_vt, missing)):
+        if line:
+            VTCACHE[vt] = line.split('_')[1]
+        else:
+            VTMISSING.add(vt)
+
+
+def vt_number(search_term):
     search_term = search_term.upper()
     search_term = search_term.replace('VT', '')
-    vt = 'VT' + search_term.zfill(6)
-    st = ''
-    if vt in VTCACHE:
-        st = VTCACHE[vt]
-    else:
-        st = translate_vt(vt)
-        if (not st):
-            logger.warning("Could not convert %s to line", vt)
-            NO_CROSSES.write("Could not convert %s to line" % (vt))
-            return()
-        st = st.split('_')[1]
-        VTCACHE[vt] = st
+    return('VT' + search_term.zfill(6))
+
+
+def convert_vt(search_term):
+    vt = vt_number(search_term)
+    translate_vts([vt])
+    if vt not in VTCACHE:
+        logger.warning("Could not convert %s to line", vt)
+        NO_CROSSES.write("Could not convert %s to line" % (vt))
+        return()
+    st = VTCACHE[vt]
     logger.debug("Converted %s to %s", vt, st)
     return(st)
 
     
-def generate_score(line):
-    if not is_gen1(line):
-        return(1)
-    suffix = line.rsplit('_', 2)
-    last = "_".join(suffix[-2:])
-    if (last in SUFFIX_SCORE):
-        return(SUFFIX_SCORE[last])
+def suffix_score(suffix):
+    """ Return the score for a Gen1 line suffix ("AE_01")
+    """
+    if (suffix in SUFFIX_SCORE):
+        return(SUFFIX_SCORE[suffix])
     else:
-        if last not in WARNED:
-            logger.warning("Using default score for suffix %s", last)
-            SUFFIX_SCORE[last] = 1
-            WARNED[last] = 1
+        if suffix not in WARNED:
+            logger.warning("Using default score for suffix %s", suffix)
+            SUFFIX_SCORE[suffix] = 1
+            WARNED[suffix] = 1
         return(1)
 
 
-def set_max_score(ad, dbd, final_score, max_score):
-    logger.debug("Score %s-x-%s = %f", ad, dbd, final_score)
-    if final_score > max_score['score']:
-        max_score['score'] = final_score
-        max_score['ad'] = ad
-        max_score['dbd'] = dbd
+def landing_site_code(line):
+    """ Return an integer code for a line's landing site
+    """
+    site = line.rpartition('_')[-1]
+    if site not in LANDING_SITE:
+        LANDING_SITE[site] = len(LANDING_SITE)
+    return(LANDING_SITE[site])
 
 
-def generate_cross(fragdict, frag1, frag2):
-    logger.debug("Attempting cross %s-x-%s", frag1, frag2)
-    max_score = {'score': -1, 'ad': '', 'dbd': ''}
-    for f1 in fragdict[frag1]:
-        # frag1 = AD, frag2 = DBD
-        if f1['type'] == 'DBD' or f1['driver'] != 'GAL4':
-            continue
-        score = generate_score(f1['line'])
-        ls1 = f1['line'].rpartition('_')[-1]
-        for f2 in fragdict[frag2]:
-            if f2['type'] == 'AD' or f2['driver'] != 'GAL4':
-                continue
-            ls2 = f2['line'].rpartition('_')[-1]
-            if (ls1 == ls2):
-                logger.error("Same landing site for %s and %s" % (f1['line'], f2['line']))
-                continue
-            final_score = score + generate_score(f2['line'])
-            set_max_score(f1['line'], f2['line'], final_score, max_score)
-            if ARG.ALL:
-                good_cross(f1['line'], f2['line'])
-    for f1 in fragdict[frag1]:
-        # frag1 = DBD, frag2 = AD
-        if f1['type'] == 'AD' or f1['driver'] != 'GAL4':
-            continue
-        score = generate_score(f1['line'])
-        ls1 = f1['line'].rpartition('_')[-1]
-        for f2 in fragdict[frag2]:
-            if f2['type'] == 'DBD' or f2['driver'] != 'GAL4':
-                continue
-            ls2 = f2['line'].rpartition('_')[-1]
-            if (ls1 == ls2):
-                logger.error("Same landing site for %s and %s" % (f1['line'], f2['line']))
-                continue
-            final_score = score + generate_score(f2['line'])
-            set_max_score(f2['line'], f1['line'], final_score, max_score)
-            if ARG.ALL:
-                good_cross(f2['line'], f1['line'])
-    return(max_score['ad'], max_score['dbd'])
+class SplitHalves:
+    """ GAL4 AD and DBD split halves for one fragment
+        Each half's line name, suffix score and landing site code are held
+        in parallel arrays, so crosses never have to re-filter or re-parse.
+    """
+    __slots__ = ('ad_line', 'ad_score', 'ad_site', 'dbd_line', 'dbd_score', 'dbd_site')
+
+    def __init__(self, halves):
+        # Non-Gen1 halves found in SAGE carry no driver
+        ad = [f['line'] for f in halves
+              if f['type'] != 'DBD' and f.get('driver', 'GAL4') == 'GAL4']
+        dbd = [f['line'] for f in halves
+               if f['type'] != 'AD' and f.get('driver', 'GAL4') == 'GAL4']
+        self.ad_line = ad
+        parsed = classify_lines(ad)
+        self.ad_score = np.array([name.score for name in parsed], dtype=np.float64)
+        self.ad_site = np.array([name.site for name in parsed], dtype=np.int32)
+        self.dbd_line = dbd
+        parsed = classify_lines(dbd)
+        self.dbd_score = np.array([name.score for name in parsed], dtype=np.float64)
+        self.dbd_site = np.array([name.site for name in parsed], dtype=np.int32)
+
+
+class SplitHalfIndex:
+    """ Index of fragment -> SplitHalves over the split_halves catalogue
+        The catalogue is a structured array (usually memory-mapped from the
+        local cache) with one row per half, grouped by fragment. A fragment's
+        SplitHalves record is only built the first time it is used.
+    """
+    __slots__ = ('catalogue', 'rows', 'records')
+
+    def __init__(self, catalogue):
+        self.catalogue = catalogue
+        frags = catalogue['fragment']
+        starts = np.concatenate(([0], np.flatnonzero(frags[1:] != frags[:-1]) + 1)) \
+                 if len(frags) else np.empty(0, dtype=np.int64)
+        stops = np.append(starts[1:], len(frags))
+        self.rows = {frag.decode(): (start, stop) for frag, start, stop
+                     in zip(frags[starts], starts.tolist(), stops.tolist())}
+        self.records = {}
+
+    def __contains__(self, frag):
+        return(frag in self.records or frag in self.rows)
+
+    def __len__(self):
+        return(len(self.rows.keys() | self.records.keys()))
+
+    def __getitem__(self, frag):
+        if frag not in self.records:
+            (start, stop) = self.rows[frag]
+            self.records[frag] = SplitHalves([{'line': row['line'].decode(),
+                                               'type': row['type'].decode(),
+                                               'driver': row['driver'].decode()}
+                                              for row in self.catalogue[start:stop]
+                                              if row['line']])
+        return(self.records[frag])
+
+    def __setitem__(self, frag, record):
+        self.records[frag] = record
+
+
+def halves_array(fragdict):
+    """ Convert the SAGE split_halves response to a structured array
+        Fragments without halves keep a row with an empty line name.
+        Keyword arguments:
+          fragdict: dictionary of fragment -> list of split halves
+        Returns:
+          structured NumPy array (fragment, line, type, driver)
+    """
+    rows = []
+    for frag, halves in fragdict.items():
+        if not halves:
+            rows.append((frag, '', '', ''))
+        for half in halves:
+            rows.append((frag, half['line'], half['type'], half.get('driver', 'GAL4')))
+    fields = ('fragment', 'line', 'type', 'driver')
+    width = [max([len(row[col].encode()) for row in rows] + [1]) for col in range(len(fields))]
+    return(np.array([tuple(col.encode() for col in row) for row in rows],
+                    dtype=[(fields[col], 'S%d' % width[col]) for col in range(len(fields))]))
+
+
+def load_split_halves(refresh=False):
+    """ Load the split half index from the local cache or SAGE
+        The cache is used if it is younger than --halves-ttl hours, unless
+        --refresh-halves is specified. It is memory-mapped on load.
+        Keyword arguments:
+          refresh: always fetch the split halves from SAGE
+        Returns:
+          SplitHalfIndex
+    """
+    refresh = refresh or ARG.REFRESH_HALVES
+    if os.path.exists(HALVES_CACHE) and not refresh and ARG.HALVES_TTL > 0:
+        age = (time.time() - os.path.getmtime(HALVES_CACHE)) / 3600.0
+        if age < ARG.HALVES_TTL:
+            logger.info("Loading split halves from %s (%.1f hours old)", HALVES_CACHE, age)
+            try:
+                return(SplitHalfIndex(np.load(HALVES_CACHE, mmap_mode='r')))
+            except (OSError, ValueError) as err:
+                logger.warning("Could not read %s: %s", HALVES_CACHE, err)
+    logger.info("Fetching split halves")
+    response = call_responder('sage', 'split_halves')
+    catalogue = halves_array(response['split_halves'])
+    if ARG.HALVES_TTL > 0:
+        tmpname = None
+        try:
+            os.makedirs(os.path.dirname(HALVES_CACHE), exist_ok=True)
+            # A private temporary file, so concurrent runs don't write the same file
+            (fdesc, tmpname) = tempfile.mkstemp(dir=os.path.dirname(HALVES_CACHE),
+                                                suffix='.tmp')
+            with os.fdopen(fdesc, 'wb') as cfile:
+                np.save(cfile, catalogue)
+            os.replace(tmpname, HALVES_CACHE)
+        except OSError as err:
+            logger.warning("Could not write %s: %s", HALVES_CACHE, err)
+            if tmpname and os.path.exists(tmpname):
+                os.remove(tmpname)
+    return(SplitHalfIndex(catalogue))
+
+
+def score_orientation(score1, site1, lines1, score2, site2, lines2, seg, npairs):
+    """ Score one orientation (rows x columns) of a block of fragment pairs
+        Keyword arguments:
+          score1/site1/lines1: halves of the first fragment (rows)
+          score2/site2/lines2: concatenated halves of the second fragments (columns)
+          seg: pair index for each column
+          npairs: number of pairs in the block
+        Returns:
+          best score, best row and best column per pair (-inf/-1 if none),
+          and the valid (row, column) entries in the original loop order
+    """
+    best = np.full(npairs, -np.inf)
+    brow = np.full(npairs, -1, dtype=np.int64)
+    bcol = np.full(npairs, -1, dtype=np.int64)
+    if not len(score1) or not len(score2):
+        return(best, brow, bcol, (np.empty(0, dtype=np.int64),) * 2)
+    same = site1[:, None] == site2[None, :]
+    for row, col in zip(*np.nonzero(same)):
+        logger.error("Same landing site for %s and %s" % (lines1[row], lines2[col]))
+    total = np.where(same, -np.inf, score1[:, None] + score2[None, :])
+    # Best per column (first row wins ties), then best per pair
+    ncol = total.shape[1]
+    colrow = total.argmax(axis=0)
+    colmax = total[colrow, np.arange(ncol)]
+    np.maximum.at(best, seg, colmax)
+    cand = np.isfinite(colmax) & (colmax == best[seg])
+    key = np.where(cand, colrow * ncol + np.arange(ncol), np.iinfo(np.int64).max)
+    first = np.full(npairs, np.iinfo(np.int64).max)
+    np.minimum.at(first, seg, key)
+    found = np.isfinite(best)
+    brow[found] = first[found] // ncol
+    bcol[found] = first[found] % ncol
+    # Valid entries ordered by pair, then row, then column
+    rows, cols = np.nonzero(~same)
+    order = np.lexsort((cols, rows, seg[cols]))
+    return(best, brow, bcol, (rows[order], cols[order]))
+
+
+def concat_halves(halves, kind):
+    """ Concatenate one kind of half (ad or dbd) over a block of fragments
+        Keyword arguments:
+          halves: list of SplitHalves
+          kind: "ad" or "dbd"
+        Returns:
+          lines, scores, landing site codes and pair index for each half
+    """
+    lines = [line for half in halves for line in getattr(half, kind + '_line')]
+    seg = np.repeat(np.arange(len(halves)),
+                    [len(getattr(half, kind + '_line')) for half in halves])
+    if not lines:
+        return(lines, np.empty(0), np.empty(0, dtype=np.int32), seg)
+    return(lines, np.concatenate([getattr(half, kind + '_score') for half in halves]),
+           np.concatenate([getattr(half, kind + '_site') for half in halves]), seg)
+
+
+def keep_best(heap, limit, item):
+    """ Add an item to a bounded min-heap that keeps the best limit items
+        Keyword arguments:
+          heap: heap list
+          limit: maximum number of items
+          item: (score, -sequence, ...) tuple
+        Returns:
+          None
+    """
+    if len(heap) < limit:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+def ranked(heap):
+    """ Return the (ad, dbd) crosses in a heap from best to worst
+        Equal scores keep the order in which the crosses were found.
+    """
+    return([item[2:] for item in sorted(heap, reverse=True)])
+
+
+def cross_score(ad, dbd):
+    """ Return the score for a cross
+    """
+    return(classify_line(ad).score + classify_line(dbd).score)
+
+
+def generate_crosses(fragindex, frag1, frag2list):
+    """ Generate the best cross for a block of fragment pairs
+        Every AD/DBD combination for frag1 against each fragment in frag2list
+        is scored at once with broadcasting. Ties are broken as a pair-by-pair
+        loop would: frag1 AD crosses first, then the first combination found.
+        With --top, the K best combinations for each pair are kept in a
+        bounded heap.
+        Keyword arguments:
+          fragindex: split half index
+          frag1: first fragment
+          frag2list: list of second fragments
+        Returns:
+          list of (ad, dbd, [all valid (ad, dbd)]) for each fragment in frag2list
+          (the K best valid (ad, dbd) with --top)
+    """
+    npairs = len(frag2list)
+    half1 = fragindex[frag1]
+    halves2 = [fragindex[frag2] for frag2 in frag2list]
+    # frag1 = AD, frag2 = DBD
+    (dbd2, dbdscore2, site2, seg1) = concat_halves(halves2, 'dbd')
+    (best1, row1, col1, valid1) = \
+        score_orientation(half1.ad_score, half1.ad_site, half1.ad_line,
+                          dbdscore2, site2, dbd2, seg1, npairs)
+    # frag1 = DBD, frag2 = AD
+    (ad2, adscore2, site2, seg2) = concat_halves(halves2, 'ad')
+    (best2, row2, col2, valid2) = \
+        score_orientation(half1.dbd_score, half1.dbd_site, half1.dbd_line,
+                          adscore2, site2, ad2, seg2, npairs)
+    result = []
+    for pair in range(npairs):
+        ad = dbd = ''
+        if best1[pair] > -1:
+            ad, dbd = half1.ad_line[row1[pair]], dbd2[col1[pair]]
+        if best2[pair] > max(best1[pair], -1):
+            ad, dbd = ad2[col2[pair]], half1.dbd_line[row2[pair]]
+        result.append([ad, dbd, []])
+    if ARG.ALL:
+        for row, col in zip(*valid1):
+            result[seg1[col]][2].append((half1.ad_line[row], dbd2[col]))
+        for row, col in zip(*valid2):
+            result[seg2[col]][2].append((ad2[col], half1.dbd_line[row]))
+    elif ARG.TOP:
+        heaps = [[] for _ in range(npairs)]
+        sequence = count()
+        scores = half1.ad_score[valid1[0]] + dbdscore2[valid1[1]]
+        for row, col, score in zip(*valid1, scores.tolist()):
+            if score > -1:
+                keep_best(heaps[seg1[col]], ARG.TOP,
+                          (score, -next(sequence), half1.ad_line[row], dbd2[col]))
+        scores = half1.dbd_score[valid2[0]] + adscore2[valid2[1]]
+        for row, col, score in zip(*valid2, scores.tolist()):
+            if score > -1:
+                keep_best(heaps[seg2[col]], ARG.TOP,
+                          (score, -next(sequence), ad2[col], half1.dbd_line[row]))
+        for pair in range(npairs):
+            result[pair][2] = ranked(heaps[pair])
+    return(result)
 
 
 def flycoreData(line):
@@ -192,91 +653,177 @@ def flycoreData(line):
         sys.exit(-1)
 
 
+def prefetch_flycore(fragindex, fraglist):
+    """ Fetch FlyCore stock data for every half that can appear in output
+        Keyword arguments:
+          fragindex: split half index
+          fraglist: fragment list
+        Returns:
+          None
+    """
+    lines = set()
+    for frag in set(fraglist):
+        lines.update(fragindex[frag].ad_line)
+        lines.update(fragindex[frag].dbd_line)
+    lines = sorted(lines.difference(fcdict, FCFIELDS))
+    logger.info("Fetching FlyCore data for %d lines", len(lines))
+    PROFILE['counters']['flycore_lines'] = len(lines)
+    with timed('flycore'):
+        call_concurrently(flycoreData, lines)
+
+
+def flycore_fields(line):
+    """ Return the FlyCore order columns for a split half
+        Keyword arguments:
+          line: split half line
+        Returns:
+          tuple of column values
+    """
+    if line not in FCFIELDS:
+        if (line not in fcdict):
+            flycoreData(line)
+        data = fcdict[line]
+        FCFIELDS[line] = (data['A_Concat_Loc'], data['__kp_UniqueID'], data['RobotID'],
+                          data['Genotype_GSI_Name_PlateWell'], data['Chromosome'], line,
+                          data['fragment'], data['Production_Info'], data['Quality_Control'])
+    return(FCFIELDS[line])
+
+
+class CrossWriter:
+    """ Buffered writer for the crosses and FlyCore order files
+        Crosses are held in batches of WRITE_BATCH rows, formatted with
+        precompiled row templates and written in one call per batch, so
+        memory use does not depend on the number of crosses. The FlyCore
+        order can also be written to a Parquet file (requires pyarrow).
+    """
+    def __init__(self, crosses, flycore, columnar=''):
+        self.crosses = crosses
+        self.flycore = flycore
+        self.rows = []
+        self.parquet = self.schema = self.table = None
+        self.flycore.write('\t'.join(FLYCORE_COLUMNS + STOCK_COLUMNS * 2) + '\n')
+        if columnar:
+            try:
+                import pyarrow  # pylint: disable=C0415
+                import pyarrow.parquet  # pylint: disable=C0415
+            except ImportError:
+                logger.critical("pyarrow is required for columnar output")
+                sys.exit(-1)
+            names = FLYCORE_COLUMNS + tuple('AD ' + col for col in STOCK_COLUMNS) \
+                    + tuple('DBD ' + col for col in STOCK_COLUMNS)
+            self.schema = pyarrow.schema([(name, pyarrow.string()) for name in names])
+            self.table = pyarrow.Table
+            self.parquet = pyarrow.parquet.ParquetWriter(columnar, self.schema)
+
+    def add(self, ad, dbd):
+        self.rows.append((ad, dbd))
+        if len(self.rows) >= WRITE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        # FlyCore data that was not prefetched is fetched for this batch only
+        missing = sorted({line for row in self.rows for line in row}.difference(fcdict,
+                                                                                FCFIELDS))
+        if missing:
+            PROFILE['counters']['flycore_lines'] = \
+                PROFILE['counters'].get('flycore_lines', 0) + len(missing)
+            with timed('flycore'):
+                call_concurrently(flycoreData, missing)
+        self.crosses.write(''.join([CROSS_ROW % row for row in self.rows]))
+        frows = []
+        for (ad, dbd) in self.rows:
+            adf = flycore_fields(ad)
+            dbdf = flycore_fields(dbd)
+            frows.append((ORDERNAME, '', ad + '-x-' + dbd, adf[6] + '-x-' + dbdf[6], '')
+                         + adf + dbdf)
+        self.flycore.write(''.join([FLYCORE_ROW % row for row in frows]))
+        if self.parquet:
+            columns = [[str(val) for val in col] for col in zip(*frows)]
+            self.parquet.write_table(self.table.from_arrays(columns, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.parquet:
+            self.parquet.close()
+
+
 def good_cross(ad, dbd):
     logger.info("Found cross %s-x-%s", ad, dbd)
-    CROSSES.write("%s-x-%s\n" % (ad, dbd))
-    if (ad not in fcdict):
-        flycoreData(ad)
-    if (dbd not in fcdict):
-        flycoreData(dbd)
-    alias = ad + '-x-' + dbd
-    pfrag = fcdict[ad]['fragment'] + '-x-' + fcdict[dbd]['fragment']
-    FLYCORE.write("%s\t%s\t%s\t%s\t%s" % (ORDERNAME, '', alias, pfrag, ''))
-    for half in (ad, dbd):
-        FLYCORE.write("\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s"
-                      % (fcdict[half]['A_Concat_Loc'],
-                         fcdict[half]['__kp_UniqueID'],
-                         fcdict[half]['RobotID'],
-                         fcdict[half]['Genotype_GSI_Name_PlateWell'],
-                         fcdict[half]['Chromosome'], half,
-                         fcdict[half]['fragment'],
-                         fcdict[half]['Production_Info'],
-                         fcdict[half]['Quality_Control']))
-    FLYCORE.write("\n")
-
-
-def search_for_ad_dbd(aline, search_term, new_term, search_option,
-                      linelist, fragdict, fragsFound):
-    found = 0
+    OUTPUT.add(ad, dbd)
+
+
+def split_half_fragment(search_term, fragindex):
+    """ Find a Gen1 fragment in the split half index
+        Keyword arguments:
+          search_term: search term
+          fragindex: split half index
+        Returns:
+          fragment name ("BJD_112C03"), or '' if not found
+    """
     if is_gen1_fragment(search_term):
-        m = re.search('([0-9]+)', search_term)
-        number = int(m.groups()[0])
+        number = int(PLATE_NUMBER.search(search_term).group())
         extended = 'GMR_' if number < 100 else 'BJD_'
         extended += search_term
-        if extended in fragdict:
-            linelist.append(extended)
-            logger.info("Found %s in split half list", extended)
-            found = 1
-    if not found:
-        response = call_responder('sage', "lines?name=" + new_term +
-                                  search_option)
-        if 'line_data' not in response:
-            logger.error("%s was not found in SAGE", search_term)
-            sys.exit(-1)
-        ld = response['line_data']
-        if ld:
-            for l in ld:
-                if search_term == l['name']:
-                    if is_gen1_fragment(search_term):
-                        logger.warning("Line %s is not a valid split half",
-                                       search_term)
-                    else:
-                        # Non Gen-1
-                        dtype = l['flycore_project'].split('-')[-1]
-                        if dtype not in ['AD', 'DBD']:
-                            logger.error("Non-Gen1 line %s is not an AD or DBD (%s)", search_term, l['flycore_project'])
-                            break
-                        fragdict[search_term] = []
-                        fragdict[search_term].append({'line': new_term, 'type': dtype})
-                        linelist.append(search_term)
-                        fragsFound[search_term] = search_term
-                        logger.info("Non-Gen1 %s (%s)", search_term, dtype)
+        if extended in fragindex:
+            return(extended)
+    return('')
+
+
+def sage_lines(query):
+    """ Search SAGE for lines
+        Keyword arguments:
+          query: (name or wildcard, search option)
+        Returns:
+          JSON
+    """
+    return(call_responder('sage', "lines?name=" + query[0] + query[1]))
+
+
+def search_for_ad_dbd(aline, search_term, new_term, response,
+                      linelist, fragindex, fragsFound):
+    if 'line_data' not in response:
+        logger.error("%s was not found in SAGE", search_term)
+        sys.exit(-1)
+    ld = response['line_data']
+    if ld:
+        for l in ld:
+            if search_term == l['name']:
+                if is_gen1_fragment(search_term):
+                    logger.warning("Line %s is not a valid split half",
+                                   search_term)
+                else:
+                    # Non Gen-1
+                    dtype = l['flycore_project'].split('-')[-1]
+                    if dtype not in ['AD', 'DBD']:
+                        logger.error("Non-Gen1 line %s is not an AD or DBD (%s)", search_term, l['flycore_project'])
                         break
-                if (('_' + search_term) not in l['name']):
-                    continue
-                fragment = re.sub('_[A-Z][A-Z]_[0-9][0-9]', '', l['name'])
-                logger.debug(l['name'] + ' -> ' + fragment)
-                if (fragment not in fragdict):
-                    logger.warning("Fragment %s does not have an AD or DBD", fragment)
+                    fragindex[search_term] = SplitHalves([{'line': new_term,
+                                                          'type': dtype}])
+                    linelist.append(search_term)
+                    fragsFound[search_term] = search_term
+                    logger.info("Non-Gen1 %s (%s)", search_term, dtype)
                     break
-                fragsFound[search_term] = fragment
-                linelist.append(fragment)
-                logger.info(fragment)
+            if (('_' + search_term) not in l['name']):
+                continue
+            fragment = line_fragment(l['name'])
+            logger.debug(l['name'] + ' -> ' + fragment)
+            if (fragment not in fragindex):
+                logger.warning("Fragment %s does not have an AD or DBD", fragment)
                 break
-        else:
-            logger.error("%s was not found in SAGE", search_term)
-            if ARG.ALINE and (aline == search_term):
-                sys.exit(-1)
+            fragsFound[search_term] = fragment
+            linelist.append(fragment)
+            logger.info(fragment)
+            break
+    else:
+        logger.error("%s was not found in SAGE", search_term)
+        if ARG.ALINE and (aline == search_term):
+            sys.exit(-1)
 
 
-def read_lines(fragdict, aline):
-    global VTCACHE
-    inputlist = []
-    linelist = []
-    fragsFound = dict()
-    frags_read = 0
-    if ARG.ALINE:
-        inputlist.append(aline)
+def read_input(inputlist):
     filename = ARG.FILE if ARG.FILE else ''
     if (not filename) and (not select.select([sys.stdin,],[],[],0.0)[0]):
         logger.critical('You must either specify a file or pass data in through STDIN')
@@ -290,23 +837,37 @@ def read_lines(fragdict, aline):
         inputlist.append(input_line)
     if filehandle is not sys.stdin:
         filehandle.close()
-    # Get cached VT conversions
-    response = call_responder('config', 'config/vt_conversion')
-    VTCACHE = response['config']
-    logger.info("Found %s entries in VT cache", len(VTCACHE))
+
+
+def read_lines(fragindex, aline, lines=None):
+    inputlist = []
+    terms = []
+    linelist = []
+    fragsFound = dict()
+    frags_read = 0
+    if ARG.ALINE:
+        inputlist.append(aline)
+    if lines is not None:
+        inputlist.extend(lines)
+    else:
+        read_input(inputlist)
+    inputlist = [input_line.rstrip() for input_line in inputlist if input_line.rstrip()]
+    parsed = classify_lines(inputlist)
+    # Translate VT numbers not in the cache
+    with timed('vt_conversion'):
+        translate_vts([vt_number(search_term) for search_term, name
+                       in zip(inputlist, parsed) if name.kind == 'vt'])
     # Process input file
-    for input_line in inputlist:
-        search_term = input_line.rstrip()
-        if not len(search_term):
-            continue
+    for search_term, name in zip(inputlist, parsed):
         frags_read += 1
         new_term = ''
-        if is_vt(search_term):
+        if name.kind == 'vt':
             search_term = convert_vt(search_term)
             if not search_term:
                 continue
-        if is_gen1_fragment(search_term) or is_gen1(search_term):
-            search_term = convert_gen1(search_term)
+            name = classify_line(search_term)
+        if name.kind in ('gen1', 'fragment'):
+            search_term = name.platewell
             new_term = '*\_' + search_term + '*'
             search_option = '&_columns=name'
         else:
@@ -319,8 +880,22 @@ def read_lines(fragdict, aline):
         else:
             fragsFound[search_term] = 1
         logger.debug(search_term + ' (' + new_term + ')')
-        search_for_ad_dbd(aline, search_term, new_term, search_option,
-                          linelist, fragdict, fragsFound)
+        terms.append((search_term, new_term, search_option))
+    # Gen1 fragments are found in the split half index, and the rest are
+    # searched for in SAGE (one concurrent search per distinct term)
+    local = {term[0]: split_half_fragment(term[0], fragindex) for term in terms}
+    queries = sorted({term[1:] for term in terms if not local[term[0]]})
+    PROFILE['counters']['sage_searches'] = len(queries)
+    with timed('line_search'):
+        response = dict(zip(queries, call_concurrently(sage_lines, queries)))
+    for (search_term, new_term, search_option) in terms:
+        if local[search_term]:
+            linelist.append(local[search_term])
+            logger.info("Found %s in split half list", local[search_term])
+            continue
+        search_for_ad_dbd(aline, search_term, new_term,
+                          response[(new_term, search_option)],
+                          linelist, fragindex, fragsFound)
     linelist.sort()
     print("Fragments read: %d" % (frags_read))
     n = len(linelist)
@@ -332,41 +907,252 @@ def read_lines(fragdict, aline):
     return(linelist, combos)
 
 
-def process_input():
-    logger.info("Fetching split halves")
+def line_fragment(line):
+    """ Return the fragment for a split half line ("BJD_112C03_BB_21" -> "BJD_112C03")
+    """
+    return(GEN1_SUFFIX.sub('', line))
+
+
+def open_input(name):
+    """ Open an input file that may be compressed with gzip
+    """
+    return(gzip.open(name, 'rt') if name.endswith('.gz') else open(name, 'r'))
+
+
+def run_mode():
+    """ Return the output mode of this run
+    """
+    return({'all': bool(ARG.ALL), 'top': ARG.TOP, 'top_order': ARG.TOP_ORDER})
+
+
+def previous_mode(base):
+    """ Return the output mode of a previous run
+        The mode is read from the run's .mode.json file, or (for results
+        without one) from the -ALL, -TOPK and -BESTN parts of its name.
+        Keyword arguments:
+          base: previous output name
+        Returns:
+          mode dictionary
+    """
+    if os.path.exists(base + '.mode.json'):
+        with open(base + '.mode.json', 'r') as mfile:
+            return(json.load(mfile))
+    name = os.path.basename(base)
+    top = re.search(r'-TOP([0-9]+)', name)
+    best = re.search(r'-BEST([0-9]+)', name)
+    return({'all': '-ALL' in name, 'top': int(top.group(1)) if top else 0,
+            'top_order': int(best.group(1)) if best else 0})
+
+
+def check_previous_mode(crossfile, mode):
+    """ Exit if previous results can not be reused by this run
+        Previous results must be complete for each pair: the same mode, or
+        at least as many crosses per pair with --top. --top-order results
+        are never complete.
+        Keyword arguments:
+          crossfile: previous crosses file
+          mode: mode of the previous run
+        Returns:
+          None
+    """
+    if mode['top_order']:
+        problem = "was run with --top-order"
+    elif mode['all'] != bool(ARG.ALL):
+        problem = "was run with%s --all" % ('' if mode['all'] else 'out')
+    elif bool(mode['top']) != bool(ARG.TOP) or mode['top'] < ARG.TOP:
+        problem = "was run with --top %d" % (mode['top']) if mode['top'] \
+                  else "was run without --top"
+    else:
+        return
+    logger.critical("%s can not be used with this run (it %s)", crossfile, problem)
+    sys.exit(-1)
+
+
+def load_previous(crossfile):
+    """ Load the results of a previous run
+        Crosses and missing crosses are stored in PREVIOUS by fragment pair,
+        and FlyCore columns from the previous FlyCore order are reused.
+        Keyword arguments:
+          crossfile: previous crosses file
+        Returns:
+          None
+    """
+    compressed = '.gz' if crossfile.endswith('.gz') else ''
+    base = re.sub(r'\.crosses\.txt(\.gz)?$', '', crossfile)
+    try:
+        check_previous_mode(crossfile, previous_mode(base))
+        with open_input(crossfile) as ifile:
+            for row in ifile:
+                (ad, dbd) = row.rstrip('\n').split('-x-')
+                key = tuple(sorted((line_fragment(ad), line_fragment(dbd))))
+                PREVIOUS.setdefault(key, []).append((ad, dbd))
+        if os.path.exists(base + '.no_crosses.txt'):
+            with open(base + '.no_crosses.txt', 'r') as ifile:
+                for row in ifile:
+                    found = re.search(r'Missing .+ for (\S+)-x-(\S+)$', row.rstrip('\n'))
+                    if found:
+                        PREVIOUS.setdefault(tuple(sorted(found.groups())), [])
+        if os.path.exists(base + '.flycore.xls' + compressed):
+            with open_input(base + '.flycore.xls' + compressed) as ifile:
+                ifile.readline()
+                for row in ifile:
+                    field = tuple(row.rstrip('\n').split('\t'))
+                    ncol = len(STOCK_COLUMNS)
+                    start = len(FLYCORE_COLUMNS)
+                    for half in (field[start:start + ncol], field[start + ncol:]):
+                        FCFIELDS[half[5]] = half
+    except (OSError, ValueError) as err:
+        logger.critical("Could not read previous results from %s: %s", crossfile, err)
+        sys.exit(-1)
+    if not (ARG.ALL or ARG.TOP) and any(len(crosses) > 1 for crosses in PREVIOUS.values()):
+        # A renamed result from an --all or --top run
+        logger.critical("%s has more than one cross per pair (was it run with --all or --top?)",
+                        crossfile)
+        sys.exit(-1)
+    logger.info("Loaded %d fragment pairs from %s", len(PREVIOUS), crossfile)
+
+
+def previous_cross(frag1, frag2):
+    """ Return a previous result in the same form as generate_crosses
+        Keyword arguments:
+          frag1: first fragment
+          frag2: second fragment
+        Returns:
+          [ad, dbd, [all (ad, dbd)]]
+    """
+    crosses = PREVIOUS[(frag1, frag2)]
+    if not crosses:
+        return(['', '', []])
+    if ARG.TOP:
+        return([crosses[0][0], crosses[0][1], crosses[:ARG.TOP]])
+    return([crosses[0][0], crosses[0][1], crosses if ARG.ALL else []])
+
+
+def row_crosses(idx):
+    """ Generate crosses for one row in the fragment list
+        The split half index and fragment list are read from SHARED, which
+        worker processes inherit when they are forked.
+        Keyword arguments:
+          idx: row index
+        Returns:
+          iterator of (frag1, frag2list, generate_crosses result)
+    """
+    (fragindex, fraglist, aline, apos) = SHARED
+    frag1 = fraglist[idx]
+    if aline and aline not in frag1:
+        # Only crosses with a later A line fragment are needed
+        frag2list = [fraglist[pos] for pos in apos[bisect.bisect_left(apos, idx):]]
+    else:
+        frag2list = [frag2 for frag2 in fraglist[idx:] if frag2 != frag1]
+    for block in range(0, len(frag2list), CROSS_BLOCK):
+        block_list = frag2list[block:block + CROSS_BLOCK]
+        if not PREVIOUS:
+            yield (frag1, block_list, generate_crosses(fragindex, frag1, block_list))
+            continue
+        # Only score pairs that are not in the previous results
+        todo = [frag2 for frag2 in block_list if (frag1, frag2) not in PREVIOUS]
+        scored = iter(generate_crosses(fragindex, frag1, todo) if todo else [])
+        yield (frag1, block_list, [previous_cross(frag1, frag2) if (frag1, frag2) in PREVIOUS
+                                   else next(scored) for frag2 in block_list])
+
+
+def score_row(idx):
+    """ Generate crosses for one row in the fragment list (pool task)
+        Keyword arguments:
+          idx: row index
+        Returns:
+          list of (frag1, frag2list, generate_crosses result)
+    """
+    return(list(row_crosses(idx)))
+
+
+def cross_rows(fragindex, fraglist, aline):
+    """ Generate crosses for every fragment pair, in fragment list order
+        With --workers, rows are scored in a pool of forked processes and
+        results are returned in the same order as a serial run.
+        Keyword arguments:
+          fragindex: split half index
+          fraglist: sorted fragment list
+          aline: A line
+        Returns:
+          iterator of (frag1, frag2list, generate_crosses result)
+    """
+    global SHARED  # pylint: disable=W0603
+    # Positions of fragments containing the A line
+    apos = [pos for pos, frag in enumerate(fraglist) if aline in frag] if aline else []
+    SHARED = (fragindex, fraglist, aline, apos)
+    nrows = len(fraglist)
+    if ARG.WORKERS <= 1:
+        for idx in range(nrows):
+            yield from row_crosses(idx)
+        return
+    # Only a few rows per worker are in flight, so scored rows don't pile
+    # up in memory ahead of a slower writer
+    window = ARG.WORKERS * 4
+    pending = deque()
+    logger.info("Scoring %d rows with %d workers", nrows, ARG.WORKERS)
+    with multiprocessing.get_context('fork').Pool(ARG.WORKERS) as pool:
+        for idx in range(nrows):
+            if len(pending) >= window:
+                yield from pending.popleft().get()
+            pending.append(pool.apply_async(score_row, (idx,)))
+        while pending:
+            yield from pending.popleft().get()
+
+
+def process_input(lines=None):
     start_time = datetime.now()
-    response = call_responder('sage', 'split_halves')
-    fragdict = response['split_halves']
-    logger.info("Found %d fragments with AD/DBDs", len(fragdict))
+    if ARG.ALL and ARG.TOP:
+        logger.critical("--all and --top can not be used together")
+        sys.exit(-1)
+    with timed('split_halves'):
+        fragindex = FRAGINDEX if FRAGINDEX is not None else load_split_halves()
+    logger.info("Found %d fragments with AD/DBDs", len(fragindex))
+    with timed('vt_conversion'):
+        if VTCACHE is None:
+            load_vt_cache()
     # Convert A line
     aline = ARG.ALINE.upper()
     if ARG.ALINE:
         original = ARG.ALINE.rstrip()
         if is_vt(original):
-            aline = convert_vt(original)
+            with timed('vt_conversion'):
+                aline = convert_vt(original)
             if not aline:
                 sys.exit(-1)
     # Find fragments
     logger.info("Processing line fragment list")
-    (fraglist, combos) = read_lines(fragdict, aline)
+    (fraglist, combos) = read_lines(fragindex, aline, lines)
     if not combos:
     	logger.critical("No theoretical crosses found")
     	sys.exit(-1)
+    # Every half can appear in --all output. Otherwise, FlyCore data is
+    # only fetched for the crosses in each batch that is written.
+    if ARG.ALL:
+        prefetch_flycore(fragindex, fraglist)
     logger.info("Generating crosses")
-    crosses = 0
-    for idx, frag1 in enumerate(fraglist):
-        for frag2 in fraglist[idx:]:
-            if (frag1 == frag2):
-                continue
-            if aline:
-                if aline not in frag1 and aline not in frag2:
-                    logger.debug("Cross does not contain A line %s", aline)
-                    continue
-            (ad, dbd) = generate_cross(fragdict, frag1, frag2)
+    crosses = pairs = 0
+    # With --top-order, only the N best crosses in the order are kept
+    best = []
+    sequence = count()
+    # Scoring is timed as it is consumed; output is the rest of the loop,
+    # without the FlyCore calls made when batches are written
+    start = time.perf_counter()
+    before = phase_seconds('scoring') + phase_seconds('flycore')
+    for frag1, block_list, result in timed_iter('scoring',
+                                                cross_rows(fragindex, fraglist, aline)):
+        pairs += len(block_list)
+        for frag2, (ad, dbd, all_crosses) in zip(block_list, result):
+            if not (ARG.ALL or ARG.TOP):
+                all_crosses = [(ad, dbd)] if (ad and dbd) else []
+            for cross in all_crosses:
+                if ARG.TOP_ORDER:
+                    keep_best(best, ARG.TOP_ORDER,
+                              (cross_score(*cross), -next(sequence)) + tuple(cross))
+                else:
+                    good_cross(*cross)
             if (ad and dbd):
                 crosses += 1
-                if not ARG.ALL:
-                    good_cross(ad, dbd)
             elif ((not ad) or (not dbd)):
                 what = "AD and DBD"
                 if ad:
@@ -376,14 +1162,189 @@ def process_input():
                 logger.warning("Missing %s for %s-x-%s", what, frag1, frag2)
                 NO_CROSSES.write("Missing %s for %s-x-%s\n" % (what, frag1,
                                                                frag2))
+    for cross in ranked(best):
+        good_cross(*cross)
+    OUTPUT.flush()
+    add_time('phases', 'output', time.perf_counter() - start
+             - (phase_seconds('scoring') + phase_seconds('flycore') - before))
     stop_time = datetime.now()
     print("Crosses found: %d/%d (%.2f%%)" % (crosses, combos, float(crosses) / float(combos) * 100.0))
     logger.info("Elapsed time: %s", (stop_time - start_time))
+    PROFILE['counters'].update({'pairs': pairs, 'crosses': crosses})
+    if ARG.REPORT or ARG.PROFILE:
+        write_profile()
+
+
+class OrderStream:
+    """ File-like object that returns an order's output as an HTTP response
+        Output is held until ORDER_BUFFER characters have been written, so an
+        order that fails early can still be answered with an error status.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.buffer = []
+        self.size = 0
+        self.started = False
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= ORDER_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if not self.started:
+            self.handler.send_response(200)
+            self.handler.send_header('Content-Type', 'text/plain')
+            self.handler.end_headers()
+            self.started = True
+        self.handler.wfile.write(''.join(self.buffer).encode())
+        self.buffer = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+
+
+def run_order(order, stream):
+    """ Run one order for the split generator service
+        Keyword arguments:
+          order: order dictionary (lines, aline, all, top, top_order, name, output)
+          stream: OrderStream for the requested output
+        Returns:
+          None
+    """
+    global ARG, ORDERNAME, OUTPUT, NO_CROSSES, PREVIOUS  # pylint: disable=W0603
+    ARG = argparse.Namespace(**vars(SERVICE_ARG))
+    # Orders run in a handler thread, and forking a pool from a threaded
+    # server can deadlock the workers
+    ARG.WORKERS = 1
+    ARG.ALINE = order.get('aline', '')
+    ARG.ALL = bool(order.get('all', False))
+    ARG.TOP = order.get('top', 0)
+    ARG.TOP_ORDER = order.get('top_order', 0)
+    ORDERNAME = find_username(order.get('name', ''))
+    PREVIOUS = {}
+    for group in PROFILE.values():
+        group.clear()
+    output = order.get('output', 'flycore')
+    with open(os.devnull, 'w') as sink:
+        NO_CROSSES = stream if output == 'no_crosses' else sink
+        OUTPUT = CrossWriter(stream if output == 'crosses' else sink,
+                             stream if output == 'flycore' else sink)
+        process_input(order['lines'])
+        OUTPUT.close()
+
+
+class OrderHandler(BaseHTTPRequestHandler):
+    """ HTTP handler for the split generator service
+        POST /order with a JSON order returns the requested output file
+        ("flycore", "crosses" or "no_crosses"). GET /status returns cache sizes.
+    """
+    def reply(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.reply(404, {'error': 'Unknown endpoint ' + self.path})
+        with ORDER_LOCK:
+            status = {'fragments': len(FRAGINDEX), 'vt_cache': len(VTCACHE),
+                      'flycore_cache': len(FCFIELDS.keys() | fcdict.keys()),
+                      'refreshed': SERVICE_STATUS['refreshed']}
+        return self.reply(200, status)
+
+    def do_POST(self):
+        if self.path != '/order':
+            return self.reply(404, {'error': 'Unknown endpoint ' + self.path})
+        try:
+            order = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(order.get('lines'), list) \
+               or order.get('output', 'flycore') not in ('flycore', 'crosses', 'no_crosses'):
+                raise ValueError('an order needs a list of lines and a valid output')
+            if any(not isinstance(order.get(key, 0), int) or order.get(key, 0) < 0
+                   for key in ('top', 'top_order')):
+                raise ValueError('top and top_order must be non-negative integers')
+            if any(not isinstance(line, str) for line in order['lines']) \
+               or any(not isinstance(order.get(key, ''), str) for key in ('aline', 'name')):
+                raise ValueError('lines, aline and name must be strings')
+        except (ValueError, AttributeError) as err:
+            return self.reply(400, {'error': 'Invalid order: %s' % (err)})
+        with ORDER_LOCK:
+            stream = OrderStream(self)
+            try:
+                run_order(order, stream)
+            except SystemExit:
+                if not stream.started:
+                    return self.reply(400, {'error': 'Order could not be processed '
+                                                     + '(see service log)'})
+                return None
+            stream.close()
+        return None
+
+
+def refresh_caches():
+    """ Refresh the service's split halves, VT and FlyCore caches on a schedule
+    """
+    global FRAGINDEX  # pylint: disable=W0603
+    while True:
+        time.sleep(SERVICE_ARG.REFRESH_INTERVAL * 60)
+        logger.info("Refreshing caches")
+        try:
+            fragindex = load_split_halves(refresh=True)
+            with ORDER_LOCK:
+                FRAGINDEX = fragindex
+                load_vt_cache()
+                VTMISSING.clear()
+                fcdict.clear()
+                FCFIELDS.clear()
+                SERVICE_STATUS['refreshed'] = datetime.now().isoformat()
+        except SystemExit:
+            logger.error("Could not refresh caches, keeping current caches")
+
+
+def serve():
+    """ Run as a local service with warm caches
+        The split half index and VT cache are loaded once, and FlyCore stock
+        data is kept between orders. All caches are refreshed every
+        --refresh-interval minutes.
+    """
+    global FRAGINDEX, SERVICE_ARG  # pylint: disable=W0603
+    SERVICE_ARG = ARG
+    if ARG.WORKERS > 1:
+        logger.warning("--workers is ignored with --serve; orders are scored serially")
+    FRAGINDEX = load_split_halves()
+    load_vt_cache()
+    SERVICE_STATUS['refreshed'] = datetime.now().isoformat()
+    threading.Thread(target=refresh_caches, daemon=True).start()
+    server = ThreadingHTTPServer(('127.0.0.1', ARG.SERVE), OrderHandler)
+    logger.warning("Serving split generator orders on port %d", ARG.SERVE)
+    server.serve_forever()
 
 
 # -----------------------------------------------------------------------------
 
 
+def positive_int(value):
+    """ Parse a count argument that must be at least 1
+        Keyword arguments:
+          value: argument value
+        Returns:
+          integer value
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % (value))
+    return(number)
+
+
 if __name__ == '__main__':
     PARSER = argparse.ArgumentParser(
         description='Generate Gen1 initial splits')
@@ -391,6 +1352,30 @@ if __name__ == '__main__':
     PARSER.add_argument('--aline', dest='ALINE', default='', help='A line')
     PARSER.add_argument('--all', action='store_true', dest='ALL',
                         default=False, help='Output all cross combinations')
+    PARSER.add_argument('--top', dest='TOP', type=positive_int, default=0,
+                        help='Output the K best crosses for each fragment pair')
+    PARSER.add_argument('--top-order', dest='TOP_ORDER', type=positive_int, default=0,
+                        help='Only output the N best crosses in the order')
+    PARSER.add_argument('--workers', dest='WORKERS', type=int, default=1,
+                        help='Number of processes to generate crosses with')
+    PARSER.add_argument('--halves-ttl', dest='HALVES_TTL', type=float, default=24,
+                        help='Hours to use cached split halves for (0 to disable)')
+    PARSER.add_argument('--refresh-halves', action='store_true', dest='REFRESH_HALVES',
+                        default=False, help='Refresh the cached split halves')
+    PARSER.add_argument('--compress', action='store_true', dest='COMPRESS',
+                        default=False, help='Write gzipped cross and FlyCore files')
+    PARSER.add_argument('--columnar', action='store_true', dest='COLUMNAR', default=False,
+                        help='Also write the FlyCore order as Parquet (requires pyarrow)')
+    PARSER.add_argument('--since', dest='SINCE', default='',
+                        help='Crosses file from a previous run (only new pairs are scored)')
+    PARSER.add_argument('--serve', dest='SERVE', type=int, default=0,
+                        help='Run as a local service on this port')
+    PARSER.add_argument('--refresh-interval', dest='REFRESH_INTERVAL', type=float,
+                        default=60, help='Minutes between service cache refreshes')
+    PARSER.add_argument('--report', dest='REPORT', default='',
+                        help='Write phase timings and counters to this JSON file')
+    PARSER.add_argument('--profile', action='store_true', dest='PROFILE',
+                        default=False, help='Write phase timings and counters to STDERR')
     PARSER.add_argument('--name', dest='NAME', default='', help='Name to use for the order')
     PARSER.add_argument('--task', dest='TASK', default='', help='Task name')
     PARSER.add_argument('--verbose', action='store_true', dest='VERBOSE',
@@ -410,33 +1395,36 @@ if __name__ == '__main__':
     HANDLER.setFormatter(colorlog.ColoredFormatter())
     logger.addHandler(HANDLER)
 
-    initialize_program(ARG.NAME)
+    with timed('config'):
+        initialize_program(ARG.NAME)
+    if ARG.SERVE:
+        serve()
     fname = ARG.FILE if ARG.FILE else ARG.TASK if ARG.TASK else 'STDIN'
     name_insert = prefix = ''
     if ARG.ALINE:
         prefix = ARG.ALINE + '-'
     if ARG.ALL:
         name_insert += '-ALL'
-    CROSSES = open(prefix + fname + name_insert + '.crosses.txt', 'w')
-    FLYCORE = open(prefix + fname + name_insert + '.flycore.xls', 'w')
-    nocross_file = prefix + fname + name_insert + '.no_crosses.txt'
+    if ARG.TOP:
+        name_insert += '-TOP%d' % (ARG.TOP)
+    if ARG.TOP_ORDER:
+        name_insert += '-BEST%d' % (ARG.TOP_ORDER)
+    if ARG.SINCE:
+        load_previous(ARG.SINCE)
+    output_file = prefix + fname + name_insert
+    CROSSES = open_output(output_file + '.crosses.txt')
+    FLYCORE = open_output(output_file + '.flycore.xls')
+    nocross_file = output_file + '.no_crosses.txt'
     NO_CROSSES = open(nocross_file, 'w')
-
-    for h in ('Who', '#', 'Alias', 'Pfrag'):
-        FLYCORE.write("%s\t" % (h))
-    FLYCORE.write('IS')
-    for i in (1, 2):
-        for h in ('__flipper_flystocks_stock::RACK_LOCATION',
-                  'StockFinder::__kp_UniqueID', 'StockFinder::RobotID',
-                  'StockFinder::Genotype_GSI_Name_PlateWell',
-                  'StockFinder::Chromosome', 'StockFinder::Stock_Name',
-                  'StockFinder::fragment', 'StockFinder::Production_Info',
-                  'StockFinder::Quality_Control'):
-            FLYCORE.write("\t%s" % (h))
-    FLYCORE.write("\n")
+    OUTPUT = CrossWriter(CROSSES, FLYCORE,
+                         output_file + '.flycore.parquet' if ARG.COLUMNAR else '')
     process_input()
+    OUTPUT.close()
     CROSSES.close()
     NO_CROSSES.close()
     if os.path.getsize(nocross_file) < 1:
         os.remove(nocross_file)
     FLYCORE.close()
+    # The mode is checked when the results are used with --since
+    with open(output_file + '.mode.json', 'w') as mfile:
+        json.dump(run_mode(), mfile)
@@ -1,8 +1,12 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
+import errno
+import hashlib
 import json
 import os
 import re
+import shutil
 import sys
 import colorlog
 from pymongo import MongoClient
@@ -31,6 +35,18 @@ CONFIG = {'config': {'url': os.environ.get('CONFIG_SERVER_URL')}}
 COUNT = {"In SAGE": 0, "Missing": 0, "Not archived": 0, "Already moved": 0, 
          "Incorrect path": 0, "Archived": 0, "In JACS": 0, "Not flylight": 0,
          "No path": 0, "Not in JACS": 0}
+# JACS images prefetched by slide code, and matches by (slide code, LSM name)
+IMAGES = dict()
+IMAGE_INDEX = dict()
+FIND_BATCH = 1000
+IMAGE_FIELDS = {"_id": 1, "name": 1, "slideCode": 1, "filepath": 1, "files.LosslessStack": 1}
+# Filesystem (size, mtime) by path, or None if the path is missing
+FILE_STAT = dict()
+SCANDIR_MIN = 16
+# Copies
+COPY_CHUNK = 64 * 1024 * 1024
+COPY_BUFFER = 16 * 1024 * 1024
+COPY_FALLBACK = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
 # Constants
 ARCHIVE_PATH = "/groups/scicomp/lsms/JACS/"
 NEW_PATH = "/nearline/flylight/lsms/JACS/"
@@ -122,19 +138,110 @@ def json_serial(obj):
     raise TypeError ("Type %s not serializable" % type(obj))
 
 
+def prefetch_images(slide_codes):
+    """ Fetch JACS images for many slide codes in batched queries
+        Keyword arguments:
+          slide_codes: list of slide codes
+    """
+    slide_codes = sorted(set(slide_codes) - set(IMAGES))
+    for start in range(0, len(slide_codes), FIND_BATCH):
+        batch = slide_codes[start:start+FIND_BATCH]
+        for slide_code in batch:
+            IMAGES[slide_code] = []
+        try:
+            response = DBM.image.find({"slideCode": {"$in": batch}},
+                                      IMAGE_FIELDS).batch_size(FIND_BATCH)
+            for entry in response:
+                IMAGES[entry["slideCode"]].append(entry)
+        except Exception as err:
+            print('Could not get sample from FlyPortal: %s' % (err))
+            sys.exit(-1)
+    LOGGER.info("Prefetched JACS images for %d slide codes", len(slide_codes))
+
+
+def list_directory(directory, paths):
+    """ Find which paths are missing from a directory with one listing
+        Keyword arguments:
+          directory: directory
+          paths: list of (file name, path)
+        Returns:
+          list of missing paths
+    """
+    try:
+        with os.scandir(directory or ".") as entries:
+            names = {entry.name for entry in entries}
+    except OSError:
+        return [path for (_, path) in paths]
+    return [path for (name, path) in paths if name not in names]
+
+
+def stat_path(path):
+    """ Return the size and mtime for a path
+        Keyword arguments:
+          path: path
+        Returns:
+          (size, mtime), or None if the path is missing
+    """
+    try:
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+
+def stat_paths(paths):
+    """ Check many paths concurrently and record them in FILE_STAT
+        Directories holding at least SCANDIR_MIN of the paths are listed
+        first, so missing files there are found without a stat call.
+        Keyword arguments:
+          paths: list of paths
+    """
+    paths = set(paths) - set(FILE_STAT)
+    by_directory = dict()
+    for path in paths:
+        (directory, name) = os.path.split(path)
+        by_directory.setdefault(directory, []).append((name, path))
+    listed = {directory: dpaths for directory, dpaths in by_directory.items()
+              if len(dpaths) >= SCANDIR_MIN}
+    with ThreadPoolExecutor(max_workers=ARG.WORKERS) as executor:
+        for missing in executor.map(list_directory, listed, listed.values()):
+            for path in missing:
+                FILE_STAT[path] = None
+        paths = sorted(paths - set(FILE_STAT))
+        for path, stat in zip(paths, executor.map(stat_path, paths)):
+            FILE_STAT[path] = stat
+    LOGGER.info("Checked %d paths in %d directories (%d listed)",
+                sum(len(dpaths) for dpaths in by_directory.values()), len(by_directory),
+                len(listed))
+
+
+def path_exists(path):
+    """ Check if a path exists, using FILE_STAT if stat_paths has seen it
+        Keyword arguments:
+          path: path
+        Returns:
+          True if the path exists
+    """
+    if path in FILE_STAT:
+        return FILE_STAT[path] is not None
+    return os.path.exists(path)
+
+
 def fetch_mongo(name, slide_code=None):
     short = re.sub("^.*\/", "", name)
-    try:
-        response = DBM.image.find({"slideCode": slide_code})
-    except Exception as err:
-        print('Could not get sample from FlyPortal: %s' % (err))
-        sys.exit(-1)
-    rec = []
-    cnt = 0
-    for entry in response:
-        if short in entry["name"]:
-            rec.append(entry)
-            cnt += 1
+    if (slide_code, short) in IMAGE_INDEX:
+        rec = IMAGE_INDEX[(slide_code, short)]
+    elif slide_code in IMAGES:
+        rec = [entry for entry in IMAGES[slide_code] if short in entry["name"]]
+        IMAGE_INDEX[(slide_code, short)] = rec
+    else:
+        try:
+            response = DBM.image.find({"slideCode": slide_code})
+        except Exception as err:
+            print('Could not get sample from FlyPortal: %s' % (err))
+            sys.exit(-1)
+        rec = [entry for entry in response if short in entry["name"]]
+    cnt = len(rec)
     if rec:
         if cnt > 1:
             pass
@@ -163,7 +270,9 @@ def produce_order():
         sql_error(err)
     LOGGER.info("LSMs in SAGE: %d", len(rows))
     COUNT["In SAGE"] = len(rows)
-    order = dict()
+    stat_paths([row["jfs_path"] if row["jfs_path"] else row["path"] for row in rows
+                if row["jfs_path"] or row["path"]])
+    archived = []
     for row in tqdm(rows):
         path = row["jfs_path"] if row["jfs_path"] else row["path"]
         if not path:
@@ -176,7 +285,7 @@ def produce_order():
             print(path)
             COUNT["Not flylight"] += 1
             continue
-        if not os.path.exists(path):
+        if not path_exists(path):
             LOGGER.error("%s is not on filesystem", path)
             COUNT["Missing"] += 1
             continue
@@ -197,6 +306,11 @@ def produce_order():
             continue
         COUNT["Archived"] += 1
         LOGGER.debug(path)
+        archived.append((row, path))
+    # Only archived LSMs are looked up in JACS
+    prefetch_images([row["slide_code"] for (row, _) in archived if row["slide_code"]])
+    order = dict()
+    for (row, path) in archived:
         jacs = fetch_mongo(row["name"], row["slide_code"])
         if not jacs:
             jacs = []
@@ -239,12 +353,23 @@ def produce_order():
         output2.close()
 
 
-def process_line(line):
+def order_paths(line):
+    """ Return the source and target paths from a line of a copy order
+        Keyword arguments:
+          line: line from the order
+        Returns:
+          source and target paths
+    """
     source,target = line.strip().split("\t")
     source = source.replace("install -D ", "")
     if ARG.REVERT:
         source, target = target, source
-    if not os.path.exists(target):
+    return source, target
+
+
+def process_line(line):
+    source, target = order_paths(line)
+    if not path_exists(target):
         LOGGER.error("%s is not on filesystem", target)
         COUNT["Missing"] += 1
         sys.exit(-1)
@@ -296,12 +421,275 @@ def process_line(line):
     COUNT["Updated"] += 1
 
 
+def copy_data(sfd, tfd, size):
+    """ Copy a file's data with copy_file_range, falling back to sendfile,
+        then to reads and writes
+        Keyword arguments:
+          sfd: source file descriptor
+          tfd: target file descriptor
+          size: source size
+    """
+    calls = (lambda: os.copy_file_range(sfd, tfd, COPY_CHUNK),
+             lambda: os.sendfile(tfd, sfd, None, COPY_CHUNK))
+    for call in calls:
+        copied = 0
+        try:
+            while copied < size:
+                sent = call()
+                if not sent:
+                    break
+                copied += sent
+            return
+        except AttributeError:
+            continue
+        except OSError as err:
+            # Only fall back if nothing was copied yet
+            if copied or err.errno not in COPY_FALLBACK:
+                raise
+    while True:
+        buf = os.read(sfd, COPY_BUFFER)
+        if not buf:
+            return
+        while buf:
+            buf = buf[os.write(tfd, buf):]
+
+
+def checksum(path):
+    """ Return the MD5 checksum for a file
+        Keyword arguments:
+          path: path
+        Returns:
+          hex digest
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as infile:
+        for buf in iter(lambda: infile.read(COPY_BUFFER), b""):
+            md5.update(buf)
+    return md5.hexdigest()
+
+
+def transfer(source, target):
+    """ Copy a file to a partial file, verify it, and move it into place
+        Keyword arguments:
+          source: source path
+          target: target path
+        Returns:
+          journal record
+    """
+    partial = target + ".partial"
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    try:
+        with open(source, "rb") as sfile, open(partial, "wb") as tfile:
+            stat = os.fstat(sfile.fileno())
+            copy_data(sfile.fileno(), tfile.fileno(), stat.st_size)
+        record = {"source": source, "target": target, "size": stat.st_size,
+                  "mtime": stat.st_mtime}
+        if os.stat(partial).st_size != stat.st_size:
+            raise ValueError("copied %d of %d bytes" % (os.stat(partial).st_size,
+                                                        stat.st_size))
+        if ARG.CHECKSUM:
+            record["md5"] = checksum(source)
+            if checksum(partial) != record["md5"]:
+                raise ValueError("checksum mismatch")
+        shutil.copystat(source, partial)
+        os.replace(partial, target)
+    except Exception:
+        try:
+            os.remove(partial)
+        except FileNotFoundError:
+            pass
+        raise
+    record["status"] = "copied"
+    return record
+
+
+def read_journal(journal):
+    """ Read a copy journal
+        Keyword arguments:
+          journal: journal path
+        Returns:
+          dictionary of source path -> latest record
+    """
+    done = dict()
+    if not os.path.exists(journal):
+        return done
+    with open(journal) as jfile:
+        for line in jfile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete after a crash
+                continue
+            done[record["source"]] = record
+    LOGGER.info("Read %d files from %s", len(done), journal)
+    return done
+
+
+def write_journal(jfile, record):
+    """ Add a record to the copy journal
+        Keyword arguments:
+          jfile: journal file
+          record: record
+    """
+    jfile.write(json.dumps(record) + "\n")
+    jfile.flush()
+    os.fsync(jfile.fileno())
+
+
+def remove_source(jfile, record):
+    """ Remove a source file after its copy has been verified
+        Keyword arguments:
+          jfile: journal file
+          record: journal record for the copy
+    """
+    if stat_path(record["source"]) != (record["size"], record["mtime"]):
+        LOGGER.error("%s changed after it was copied, so it was not removed",
+                     record["source"])
+        COUNT["Not removed"] += 1
+        return
+    target = stat_path(record["target"])
+    if not target or target[0] != record["size"]:
+        LOGGER.error("%s does not match its source, so %s was not removed",
+                     record["target"], record["source"])
+        COUNT["Not removed"] += 1
+        return
+    try:
+        os.remove(record["source"])
+    except OSError as err:
+        LOGGER.error("Could not remove %s: %s", record["source"], err)
+        COUNT["Not removed"] += 1
+        return
+    write_journal(jfile, dict(record, status="removed"))
+    COUNT["Removed"] += 1
+
+
+def target_in_sage(target):
+    """ Check if SAGE has been updated (with --update) to a target path
+        Keyword arguments:
+          target: target path
+        Returns:
+          True if SAGE has the target path
+    """
+    try:
+        CURSOR["sage"].execute(READ["FROMLSM2"], (target,))
+        rows = CURSOR["sage"].fetchall()
+    except Exception as err:
+        sql_error(err)
+    return bool(rows)
+
+
+def remove_sources(pairs, done, jfile):
+    """ Remove the sources of verified copies whose targets are in SAGE
+        Keyword arguments:
+          pairs: list of (source, target)
+          done: dictionary of source path -> latest journal record
+          jfile: journal file
+    """
+    for (source, target) in tqdm(pairs):
+        record = done.get(source)
+        if record and record["target"] == target and record["status"] == "removed":
+            continue
+        if not record or record["target"] != target:
+            LOGGER.error("%s has not been copied, so it was not removed", source)
+            COUNT["Not removed"] += 1
+            continue
+        if not target_in_sage(target):
+            LOGGER.error("SAGE does not have %s (run --update first), so %s was not removed",
+                         target, source)
+            COUNT["Not removed"] += 1
+            continue
+        if ARG.WRITE:
+            remove_source(jfile, record)
+        else:
+            COUNT["To remove"] += 1
+
+
+def finish_copy(jfile, future, source):
+    """ Journal a completed copy
+        Keyword arguments:
+          jfile: journal file
+          future: future for the copy
+          source: source path
+    """
+    try:
+        record = future.result()
+    except (OSError, ValueError) as err:
+        LOGGER.error("Could not copy %s: %s", source, err)
+        COUNT["Copy failed"] += 1
+        return
+    write_journal(jfile, record)
+    COUNT["Copied"] += 1
+    COUNT["Bytes copied"] += record["size"]
+
+
+def copy_files():
+    """ Copy the files in a copy order, recording each one in a journal.
+        Files already in the journal are skipped, so an interrupted run
+        can be repeated. With --remove, nothing is copied. Instead, sources
+        are removed once their copy is verified and --update has recorded
+        the target in SAGE.
+    """
+    with open(ARG.COPY) as infile:
+        pairs = [order_paths(line) for line in infile if line.strip()]
+    LOGGER.info("Files in copy order: %d", len(pairs))
+    for key in ("In file", "To copy", "Copied", "Bytes copied", "Already copied",
+                "Copy failed", "To remove", "Removed", "Not removed"):
+        COUNT[key] = 0
+    COUNT["In file"] = len(pairs)
+    journal = ARG.COPY + ".journal"
+    done = read_journal(journal)
+    jfile = open(journal, "a") if ARG.WRITE else None
+    if ARG.REMOVE:
+        remove_sources(pairs, done, jfile)
+        if jfile:
+            jfile.close()
+        return
+    stat_paths([source for (source, _) in pairs]
+               + [record["target"] for record in done.values()])
+    todo = []
+    for (source, target) in pairs:
+        record = done.get(source)
+        if record and record["target"] == target \
+           and (FILE_STAT.get(target) or (None,))[0] == record["size"]:
+            COUNT["Already copied"] += 1
+            continue
+        if not path_exists(source):
+            LOGGER.error("%s is not on filesystem", source)
+            COUNT["Missing"] += 1
+            continue
+        todo.append((source, target))
+        COUNT["To copy"] += 1
+    if not ARG.WRITE:
+        return
+    with ThreadPoolExecutor(max_workers=ARG.COPY_WORKERS) as executor:
+        futures = {executor.submit(transfer, source, target): source
+                   for (source, target) in todo}
+        pending = set(futures)
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                pending.discard(future)
+                finish_copy(jfile, future, futures[future])
+        except KeyboardInterrupt:
+            # Copies in progress are allowed to finish and are journaled
+            LOGGER.warning("Interrupted, waiting for copies in progress")
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+            for future in pending:
+                if not future.cancelled():
+                    finish_copy(jfile, future, futures[future])
+            raise
+        finally:
+            jfile.close()
+
+
 def update_databases():
     with open(ARG.UPDATE) as input:
         lines = [ line.strip() for line in input ]
     LOGGER.info("LSMs in input file: %d", len(lines))
     COUNT["In file"] = len(lines)
     COUNT["JACS rows"] = COUNT["SAGE rows"] = COUNT["Updated"] = 0
+    stat_paths([order_paths(line)[1] for line in lines])
     for line in tqdm(lines):
         process_line(line)
     if ARG.WRITE:
@@ -309,6 +697,19 @@ def update_databases():
 
 
 def move_files():
+    if ARG.COPY:
+        copy_files()
+        print("Files in copy order:     %d" % (COUNT["In file"]))
+        print("Files to copy:           %d" % (COUNT["To copy"]))
+        print("Files copied:            %d" % (COUNT["Copied"]))
+        print("Bytes copied:            %d" % (COUNT["Bytes copied"]))
+        print("Already copied:          %d" % (COUNT["Already copied"]))
+        print("Copies failed:           %d" % (COUNT["Copy failed"]))
+        print("Sources to remove:       %d" % (COUNT["To remove"]))
+        print("Sources removed:         %d" % (COUNT["Removed"]))
+        print("Sources not removed:     %d" % (COUNT["Not removed"]))
+        print("Missing from filesystem: %d" % (COUNT["Missing"]))
+        return
     LOGGER.info("Processing data set %s", ARG.DATASET)
     if ARG.UPDATE:
         update_databases()
@@ -339,8 +740,18 @@ if __name__ == '__main__':
                         choices=['dev', 'prod'], default='prod', help='Manifold')
     PARSER.add_argument('--update', dest='UPDATE', action='store',
                         default='', help='File to update SAGE and JACS')
+    PARSER.add_argument('--copy', dest='COPY', action='store',
+                        default='', help='Copy order to run (<dataset>_copy.cmd)')
+    PARSER.add_argument('--copy-workers', dest='COPY_WORKERS', action='store', type=int,
+                        default=8, help='Number of files to copy at once')
+    PARSER.add_argument('--checksum', dest='CHECKSUM', action='store_true',
+                        default=False, help='Verify copies with an MD5 checksum')
+    PARSER.add_argument('--remove', dest='REMOVE', action='store_true',
+                        default=False, help='Remove sources of verified copies (after --update)')
     PARSER.add_argument('--revert', dest='REVERT', action='store_true',
                         default=False, help='Revert to original values')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        default=16, help='Number of threads for filesystem checks')
     PARSER.add_argument('--write', dest='WRITE', action='store_true',
                         default=False, help='Write')
     PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
@@ -359,7 +770,12 @@ if __name__ == '__main__':
     HANDLER = colorlog.StreamHandler()
     HANDLER.setFormatter(colorlog.ColoredFormatter())
     LOGGER.addHandler(HANDLER)
-    initialize_program()
+    if ARG.REMOVE and not ARG.COPY:
+        LOGGER.error("--remove can only be used with --copy")
+        sys.exit(-1)
+    # Removing sources checks SAGE for their targets
+    if ARG.REMOVE or not ARG.COPY:
+        initialize_program()
     move_files()
     sys.exit(0)
 
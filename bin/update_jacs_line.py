@@ -2,30 +2,50 @@
 '''
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import json
 from os import path, remove
 import sys
+import threading
 from time import strftime
 import bson
+from bson import json_util
 import colorlog
 import requests
 import MySQLdb
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from tqdm import tqdm
 
 
 # Configuration
 CONFIG = {'config': {'url': 'http://config.int.janelia.org/'}}
-COUNT = {'images': 0, 'imagemm': 0, 'imageup': 0, 'lines': 0, 'missingj': 0,
-         'missingl': 0, 'missings': 0, 'noprop': 0, 'samples': 0, 'samplemm': 0,
-         'sampleup': 0, 'slide_codes': 0}
+COUNT = {'images': 0, 'imagemm': 0, 'imagestale': 0, 'imageup': 0, 'lines': 0,
+         'missingj': 0, 'missingl': 0, 'missings': 0, 'noprop': 0, 'samples': 0,
+         'samplemm': 0, 'samplestale': 0, 'sampleup': 0, 'slide_codes': 0}
 CROSSPROPS = ['cross_description', 'effector_description', 'lab_member', 'lab_project']
 # Database
 CONN = dict()
 CURSOR = dict()
+DATABASE = dict()
+FIND_BATCH = 1000
+KEY_FIELDS = ('dataSet', 'slideCode', 'crossBarcode')
+WORKER = threading.local()
+# Checkpoint journal
+DONE = 0
+JOURNAL = ''
+# Change plan
+PLAN = None
 DBM = PROPMAP = PROPSET = ''
+# Queued Mongo updates, and the values they set by document ID
+UPDATES = {'sample': [], 'image': []}
+PENDING = {'sample': {}, 'image': {}}
+# Documents fetched for the current batch by document ID
+DOCS = {'sample': {}, 'image': {}}
 READ = {"LINEPROP": "SELECT type,value FROM line_property_vw WHERE name=%s ORDER BY 1",
         "IMAGEPROP": "SELECT data_set,cross_barcode,!REPLACE! FROM image_data_mv WHERE "
-                     + "slide_code=%s GROUP BY 1,2,3",
+                     + "slide_code=%s GROUP BY 1,2,!REPLACE!",
         "IMAGES": "SELECT DISTINCT data_set,slide_code FROM image_data_mv WHERE line=%s "
                   + "AND data_set IS NOT NULL AND slide_code IS NOT NULL ORDER BY 1,2",
        }
@@ -66,6 +86,20 @@ def db_connect(dbd):
         sql_error(err)
 
 
+def sage_cursor():
+    """ Return the SAGE cursor for this thread
+        Each --workers thread opens its own connection the first time it is
+        called.
+        Returns:
+          cursor
+    """
+    if threading.current_thread() is threading.main_thread():
+        return CURSOR['sage']
+    if not hasattr(WORKER, 'cursor'):
+        (WORKER.conn, WORKER.cursor) = db_connect(DATABASE['sage'])
+    return WORKER.cursor
+
+
 def call_responder(server, endpoint):
     """ Call a responder and return JSON
         Keyword arguments:
@@ -95,7 +129,8 @@ def initialize_program():
     data = call_responder('config', 'config/sage_jacs_property_mapping')
     PROPMAP = data['config']
     data = call_responder('config', 'config/db_config')
-    (CONN['sage'], CURSOR['sage']) = db_connect(data['config']['sage']['prod'])
+    DATABASE['sage'] = data['config']['sage']['prod']
+    (CONN['sage'], CURSOR['sage']) = db_connect(DATABASE['sage'])
     # Connect to Mongo
     rwp = 'write' if ARG.WRITE else 'read'
     try:
@@ -113,186 +148,547 @@ def initialize_program():
         sys.exit(-1)
 
 
-def update_sample(sid, sage_prop):
+def flush_updates(collection):
+    """ Send queued updates for a collection to Mongo
+        Keyword arguments:
+          collection: "sample" or "image"
+        Returns:
+          None
+    """
+    operations = UPDATES[collection]
+    if not operations:
+        return
+    UPDATES[collection] = []
+    PENDING[collection] = {}
+    try:
+        result = DBM[collection].bulk_write(operations, ordered=False)
+    except BulkWriteError as err:
+        COUNT[collection + 'up'] += err.details['nModified']
+        LOGGER.critical('Could not update %s in FlyPortal: %s', collection,
+                        err.details['writeErrors'][0]['errmsg'])
+        sys.exit(-1)
+    except Exception as err:
+        LOGGER.critical('Could not update %s in FlyPortal: %s', collection, err)
+        sys.exit(-1)
+    COUNT[collection + 'up'] += result.modified_count
+    # Only conditional (--apply) updates can fail to match
+    COUNT[collection + 'stale'] += len(operations) - result.matched_count
+
+
+def queue_update(collection, oid, setdict, match=None):
+    """ Queue an update, and send the queue once it reaches --batch updates
+        Keyword arguments:
+          collection: "sample" or "image"
+          oid: document ID
+          setdict: values to set
+          match: additional filter the document must match
+        Returns:
+          None
+    """
+    # Unordered writes to the same document could be applied in any order
+    if oid in PENDING[collection]:
+        flush_updates(collection)
+    UPDATES[collection].append(UpdateOne(dict({"_id": oid}, **(match or {})),
+                                         {"$set": setdict}))
+    PENDING[collection][oid] = setdict
+    if oid in DOCS[collection]:
+        DOCS[collection][oid].update(setdict)
+    if len(UPDATES[collection]) >= ARG.BATCH:
+        flush_updates(collection)
+
+
+def pending_doc(collection, doc):
+    """ Apply queued (not yet written) values to a document read from Mongo
+        Keyword arguments:
+          collection: "sample" or "image"
+          doc: document
+        Returns:
+          document
+    """
+    if doc['_id'] in PENDING[collection]:
+        doc.update(PENDING[collection][doc['_id']])
+    return doc
+
+
+def fetch_documents(collection, keys):
+    """ Fetch the samples or images for a batch of keys in one query
+        Keyword arguments:
+          collection: "sample" or "image"
+          keys: list of (data set, slide code, cross barcode or None)
+        Returns:
+          dictionary of key -> list of documents
+    """
+    found = {key: [] for key in keys}
+    DOCS[collection] = {}
+    if not keys:
+        return found
+    payload = {'dataSet': {'$in': sorted({key[0] for key in keys})},
+               'slideCode': {'$in': sorted({key[1] for key in keys})},
+               'sageSynced': True}
+    # Only the key fields and the mapped properties are read
+    projection = {field: 1 for field in KEY_FIELDS}
+    projection.update({PROPMAP[PROPSET][prop]: 1 for prop in ARG.PROPERTY})
+    try:
+        for doc in DBM[collection].find(payload, projection).batch_size(FIND_BATCH):
+            doc = pending_doc(collection, doc)
+            DOCS[collection][doc['_id']] = doc
+            # A set, so a document without a cross barcode is only added once
+            for key in {(doc['dataSet'], doc['slideCode'], None),
+                        (doc['dataSet'], doc['slideCode'], doc.get('crossBarcode'))}:
+                if key in found:
+                    found[key].append(doc)
+    except Exception as err:
+        LOGGER.error('Could not get %s from FlyPortal: %s', collection, err)
+        sys.exit(-1)
+    return found
+
+
+def write_change(kind, oid, field, jacs_prop, sage_prop):
+    """ Write a change to the changes file
+        The JACS field name is only written when more than one property is
+        being updated.
+        Keyword arguments:
+          kind: "sample" or "image"
+          oid: document ID
+          field: JACS field name
+          jacs_prop: property from JACS
+          sage_prop: property from SAGE
+        Returns:
+          None
+    """
+    if len(ARG.PROPERTY) > 1:
+        CHANGES.write("%s\t%s\t%s\t%s\t%s\n" % (kind, oid, field, jacs_prop, sage_prop))
+    else:
+        CHANGES.write("%s\t%s\t%s\t%s\n" % (kind, oid, jacs_prop, sage_prop))
+
+
+def compare_props(kind, doc, sage_props):
+    """ Compare a sample or image with SAGE
+        Keyword arguments:
+          kind: "sample" or "image"
+          doc: sample or image document
+          sage_props: dictionary of property -> value from SAGE
+        Returns:
+          dictionary of JACS field -> SAGE value for fields that need updating
+    """
+    setdict = dict()
+    for prop, sage_prop in sage_props.items():
+        field = PROPMAP[PROPSET][prop]
+        jacs_prop = doc[field] if field in doc else ''
+        if jacs_prop != sage_prop:
+            LOGGER.debug("SAGE (%s) does not match %s (%s) for JACS:%s %s",
+                         sage_prop, kind, jacs_prop, kind, doc['_id'])
+            write_change(kind, doc['_id'], field, jacs_prop, sage_prop)
+            setdict[field] = sage_prop
+            if prop == 'flycore_project':
+                setdict[PROPMAP['image']['driver']] = sage_prop
+        elif ARG.DEBUG:
+            LOGGER.debug("%s %s (%s) matches in SAGE and JACS", kind.capitalize(),
+                         doc['_id'], jacs_prop)
+    return setdict
+
+
+def update_sample(sid, setdict, match=None):
     """ Update the sample in JACS
         Keyword arguments:
           sid: sample ID
-          sage_prop: lineprop from SAGE
+          setdict: fields to set
+          match: additional filter the sample must match
         Returns:
           None
     """
     COUNT['samplemm'] += 1
     if ARG.WRITE:
-        setdict = {PROPMAP[PROPSET][ARG.PROPERTY]: sage_prop}
-        if ARG.PROPERTY == 'flycore_project':
-            setdict[PROPMAP['image']['driver']] = sage_prop
-        data = DBM.sample.update_one({"_id": sid},
-                                     {"$set": setdict})
-        COUNT['sampleup'] += data.modified_count
+        queue_update('sample', sid, setdict, match)
     else:
         COUNT['sampleup'] += 1
 
 
-def update_image(iid, sage_prop):
+def update_image(iid, setdict, match=None):
     """ Update the image in JACS
         Keyword arguments:
           iid: image ID
-          sage_prop: lineprop from SAGE
+          setdict: fields to set
+          match: additional filter the image must match
         Returns:
           None
     """
     COUNT['imagemm'] += 1
     if ARG.WRITE:
-        setdict = {PROPMAP[PROPSET][ARG.PROPERTY]: sage_prop}
-        if ARG.PROPERTY == 'flycore_project':
-            setdict[PROPMAP['image']['driver']] = sage_prop
-        data = DBM.image.update_one({"_id": iid},
-                                    {"$set": setdict})
-        COUNT['imageup'] += data.modified_count
+        queue_update('image', iid, setdict, match)
     else:
         COUNT['imageup'] += 1
 
 
-def update_jacs_images(payload, sage_prop):
+def update_jacs_images(images, sage_props):
     """ Update images in JACS
         Keyword arguments:
-        payload: Mongo search payload
-          sage_prop: property from SAGE
+          images: image documents
+          sage_props: dictionary of property -> value from SAGE
         Returns:
           None
     """
-    try:
-        cursor = DBM.image.find(payload)
-    except Exception as err:
-        LOGGER.error('Could not get sample from FlyPortal: %s', err)
-        sys.exit(-1)
-    for image in cursor:
+    for image in images:
         COUNT['images'] += 1
-        prop = image[PROPMAP[PROPSET][ARG.PROPERTY]] \
-               if PROPMAP[PROPSET][ARG.PROPERTY] in image else ''
-        if prop != sage_prop:
-            LOGGER.debug("SAGE (%s) does not match image (%s) for JACS:image %s",
-                         sage_prop, prop, image['_id'])
-            CHANGES.write("image\t%s\t%s\t%s\n" % (image['_id'], prop, sage_prop))
-            update_image(image['_id'], sage_prop)
-        elif ARG.DEBUG:
-            LOGGER.debug("Image %s (%s) matches in SAGE and JACS", image['_id'], prop)
+        setdict = compare_props('image', image, sage_props)
+        if setdict:
+            update_image(image['_id'], setdict)
 
 
-def update_jacs(slide_code, data_set, barcode, sage_prop):
+def update_jacs(slide_code, data_set, sage_props, samples, images):
     """ Update sample and images in JACS
         Keyword arguments:
           slide_code: image slide code
           data_set: image data set
-          barcode: cross barcode
-          sage_prop: property from SAGE
+          sage_props: dictionary of property -> value from SAGE
+          samples: sample documents
+          images: image documents
         Returns:
           None
     """
     # Sample
-    payload = {'dataSet': data_set, 'slideCode': slide_code, 'sageSynced': True}
-    if barcode:
-        payload['crossBarcode'] = bson.Int64(barcode)
-    try:
-        cursor = DBM.sample.find(payload)
-    except Exception as err:
-        LOGGER.error('Could not get sample from FlyPortal: %s', err)
-        sys.exit(-1)
-    if not cursor:
-        LOGGER.error("%s (%s) was not found in JACS", data_set, slide_code)
-        COUNT['missingj'] += 1
-        return
-    prop = sid = ''
-    checked = False
-    for dset in cursor:
-        checked = True
-        if sid:
+    sample = None
+    for dset in samples:
+        if sample:
             LOGGER.error("%s (%s) has multiple samples in JACS", data_set, slide_code)
             return
-        if PROPMAP[PROPSET][ARG.PROPERTY] not in dset:
-            LOGGER.debug("Sample %s does not have a %s", dset['_id'],
-                         PROPMAP[PROPSET][ARG.PROPERTY])
-            COUNT['noprop'] += 1
-        else:
-            prop = dset[PROPMAP[PROPSET][ARG.PROPERTY]]
-        sid = dset['_id']
-    if not checked:
+        for prop in sage_props:
+            if PROPMAP[PROPSET][prop] not in dset:
+                LOGGER.debug("Sample %s does not have a %s", dset['_id'],
+                             PROPMAP[PROPSET][prop])
+                COUNT['noprop'] += 1
+        sample = dset
+    if not sample:
         LOGGER.error("%s (%s) was not found in JACS", data_set, slide_code)
         COUNT['missingj'] += 1
         return
     COUNT['samples'] += 1
-    if prop != sage_prop:
-        LOGGER.debug("SAGE (%s) does not match sample (%s) for JACS:sample %s",
-                     sage_prop, prop, sid)
-        CHANGES.write("sample\t%s\t%s\t%s\n" % (sid, prop, sage_prop))
-        update_sample(sid, sage_prop)
+    setdict = compare_props('sample', sample, sage_props)
+    if setdict:
+        update_sample(sample['_id'], setdict)
     elif ARG.DEBUG:
-        LOGGER.debug("Sample %s (%s) matches in SAGE and JACS", sid, prop)
         return
     # Images
-    update_jacs_images(payload, sage_prop)
+    update_jacs_images(images, sage_props)
+
+
+def update_jacs_batch(updates):
+    """ Update samples and images in JACS for a batch of SAGE properties
+        Samples and images for the whole batch are fetched before comparing.
+        Keyword arguments:
+          updates: list of (slide code, data set, cross barcode, properties)
+        Returns:
+          None
+    """
+    if not updates:
+        return
+    keys = [(data_set, slide_code, bson.Int64(barcode) if barcode else None)
+            for (slide_code, data_set, barcode, _) in updates]
+    samples = fetch_documents('sample', keys)
+    # Images are only compared for keys with exactly one sample
+    images = fetch_documents('image', [key for key in keys if len(samples[key]) == 1])
+    for key, (slide_code, data_set, _, sage_props) in zip(keys, updates):
+        update_jacs(slide_code, data_set, sage_props, samples[key], images.get(key, []))
+
+
+def count_samples(keys):
+    """ Count the samples for a batch of keys in one query
+        Keyword arguments:
+          keys: list of (data set, slide code, cross barcode or None)
+        Returns:
+          dictionary of key -> number of samples
+    """
+    branches = []
+    for (data_set, slide_code, barcode) in keys:
+        branch = {'dataSet': data_set, 'slideCode': slide_code}
+        if barcode:
+            branch['crossBarcode'] = barcode
+        branches.append(branch)
+    pipeline = [{'$match': {'sageSynced': True, '$or': branches}},
+                {'$group': {'_id': {field: '$' + field for field in KEY_FIELDS},
+                            'count': {'$sum': 1}}}]
+    try:
+        groups = list(DBM['sample'].aggregate(pipeline, batchSize=FIND_BATCH))
+    except Exception as err:
+        LOGGER.error('Could not get sample from FlyPortal: %s', err)
+        sys.exit(-1)
+    found = {key: 0 for key in keys}
+    for group in groups:
+        (data_set, slide_code) = (group['_id']['dataSet'], group['_id']['slideCode'])
+        # As in fetch_documents, a group without a cross barcode counts once
+        for key in {(data_set, slide_code, None),
+                    (data_set, slide_code, group['_id'].get('crossBarcode'))}:
+            if key in found:
+                found[key] += group['count']
+    return found
+
+
+def plan_batch(updates):
+    """ Find samples and images that differ from SAGE, and add them to the plan
+        The comparison is done by Mongo, so only mismatched documents are
+        returned.
+        Keyword arguments:
+          updates: list of (slide code, data set, cross barcode, properties)
+        Returns:
+          None
+    """
+    if not updates:
+        return
+    branches = []
+    bykey = dict()
+    for (slide_code, data_set, barcode, sage_props) in updates:
+        branch = {'dataSet': data_set, 'slideCode': slide_code}
+        if barcode:
+            branch['crossBarcode'] = bson.Int64(barcode)
+        branch['$or'] = [{PROPMAP[PROPSET][prop]: {'$ne': val}}
+                         for prop, val in sage_props.items()]
+        branches.append(branch)
+        key = (data_set, slide_code, bson.Int64(barcode) if barcode else None)
+        bykey.setdefault(key, []).append((len(branches), sage_props))
+    # As in update_jacs, only keys with exactly one sample are changed
+    single = set()
+    found = count_samples(list(bykey))
+    for (data_set, slide_code, barcode) in bykey:
+        if found[(data_set, slide_code, barcode)] > 1:
+            LOGGER.error("%s (%s) has multiple samples in JACS", data_set, slide_code)
+        elif not found[(data_set, slide_code, barcode)]:
+            LOGGER.error("%s (%s) was not found in JACS", data_set, slide_code)
+            COUNT['missingj'] += len(bykey[(data_set, slide_code, barcode)])
+        else:
+            COUNT['samples'] += len(bykey[(data_set, slide_code, barcode)])
+            single.add((data_set, slide_code, barcode))
+    projection = {field: 1 for field in KEY_FIELDS}
+    projection.update({PROPMAP[PROPSET][prop]: 1 for prop in ARG.PROPERTY})
+    pipeline = [{'$match': {'sageSynced': True, '$or': branches}},
+                {'$project': projection}]
+    for collection in ('sample', 'image'):
+        try:
+            docs = list(DBM[collection].aggregate(pipeline, batchSize=FIND_BATCH))
+        except Exception as err:
+            LOGGER.error('Could not get %s from FlyPortal: %s', collection, err)
+            sys.exit(-1)
+        for doc in docs:
+            # SAGE properties for every key that matches, in input order
+            sage_props = dict()
+            entries = []
+            for key in {(doc['dataSet'], doc['slideCode'], None),
+                        (doc['dataSet'], doc['slideCode'], doc.get('crossBarcode'))}:
+                if key in single:
+                    entries.extend(bykey[key])
+            for _, props in sorted(entries, key=lambda entry: entry[0]):
+                sage_props.update(props)
+            setdict = dict()
+            old = dict()
+            for prop, sage_prop in sage_props.items():
+                field = PROPMAP[PROPSET][prop]
+                jacs_prop = doc[field] if field in doc else ''
+                if jacs_prop != sage_prop:
+                    setdict[field] = sage_prop
+                    old[field] = jacs_prop
+                    if prop == 'flycore_project':
+                        setdict[PROPMAP['image']['driver']] = sage_prop
+            if setdict:
+                COUNT[collection + 'mm'] += 1
+                PLAN.write(json_util.dumps({'collection': collection, '_id': doc['_id'],
+                                            'set': setdict, 'old': old}) + "\n")
+
+
+def read_plan_header():
+    """ Read the properties from a change plan's header
+        Returns:
+          list of properties
+    """
+    try:
+        with open(ARG.APPLY) as pfile:
+            return json.loads(pfile.readline())['properties']
+    except (OSError, ValueError, KeyError) as err:
+        LOGGER.critical("Could not read plan %s: %s", ARG.APPLY, err)
+        sys.exit(-1)
+
+
+def stale_filter(expected):
+    """ Build a filter that only matches documents still holding planned values
+        Keyword arguments:
+          expected: dictionary of field -> value
+        Returns:
+          filter
+    """
+    # Fields missing from JACS were planned as ''
+    return {field: {'$in': ['', None]} if value == '' else value
+            for field, value in expected.items()}
+
+
+def apply_changes(changes, applied):
+    """ Apply a batch of planned changes
+        Documents are read again first, and any that changed since the plan
+        was written are skipped. Updates are also filtered on the planned
+        values, so later changes are not overwritten.
+        Keyword arguments:
+          changes: list of changes from the plan
+          applied: dictionary of collection -> document ID -> values set by this run
+        Returns:
+          None
+    """
+    current = dict()
+    for collection in ('sample', 'image'):
+        ids = [change['_id'] for change in changes if change['collection'] == collection]
+        if not ids:
+            continue
+        fields = {field for change in changes if change['collection'] == collection
+                  for field in change['old']}
+        try:
+            for doc in DBM[collection].find({'_id': {'$in': ids}},
+                                            {field: 1 for field in fields}):
+                current[(collection, doc['_id'])] = doc
+        except Exception as err:
+            LOGGER.error('Could not get %s from FlyPortal: %s', collection, err)
+            sys.exit(-1)
+    for change in changes:
+        (collection, oid) = (change['collection'], change['_id'])
+        done = applied[collection].setdefault(oid, dict())
+        # A field this run already changed is expected to hold the new value
+        expected = {field: done.get(field, old) for field, old in change['old'].items()}
+        doc = current.get((collection, oid))
+        if doc is None or any(done.get(field, doc[field] if field in doc else '') != value
+                              for field, value in expected.items()):
+            LOGGER.warning("%s %s has changed since the plan was written", collection, oid)
+            COUNT[collection + 'stale'] += 1
+            continue
+        for field, jacs_prop in expected.items():
+            write_change(collection, oid, field, jacs_prop, change['set'][field])
+        done.update(change['set'])
+        if collection == 'sample':
+            update_sample(oid, change['set'], stale_filter(expected))
+        else:
+            update_image(oid, change['set'], stale_filter(expected))
+
+
+def apply_plan():
+    """ Apply a change plan written by --plan
+        Returns:
+          None
+    """
+    applied = {'sample': dict(), 'image': dict()}
+    try:
+        with open(ARG.APPLY) as pfile:
+            pfile.readline()
+            while True:
+                changes = [json_util.loads(row) for row in islice(pfile, FIND_BATCH)]
+                if not changes:
+                    break
+                apply_changes(changes, applied)
+    except (OSError, ValueError, KeyError) as err:
+        LOGGER.critical("Could not read plan %s: %s", ARG.APPLY, err)
+        sys.exit(-1)
 
 
 def process_single_line(line):
-    """ Update properties for one line on JACS
+    """ Get the SAGE properties for one line's images
         Keyword arguments:
           line: line
         Returns:
-          None
+          COUNT key, and list of (slide code, data set, cross barcode, properties)
     """
+    cursor = sage_cursor()
     try:
-        CURSOR['sage'].execute(READ['LINEPROP'], (line, ))
-        rows = CURSOR['sage'].fetchall()
+        cursor.execute(READ['LINEPROP'], (line, ))
+        rows = cursor.fetchall()
     except Exception as err:
         sql_error(err)
     if not rows:
         LOGGER.error("%s was not found in SAGE", line)
-        COUNT['missingl'] += 1
-        return
-    COUNT['lines'] += 1
+        return 'missingl', []
     lineprop = dict()
     for row in rows:
         lineprop[row['type']] = row['value']
-    LOGGER.info("%s (%s)", line, lineprop[ARG.PROPERTY])
+    sage_props = dict()
+    for prop in ARG.PROPERTY:
+        if prop not in lineprop:
+            LOGGER.warning("%s is not set for line %s", prop, line)
+            continue
+        sage_props[prop] = lineprop[prop]
+    if not sage_props:
+        return 'lines', []
+    LOGGER.info("%s (%s)", line, ', '.join([str(val) for val in sage_props.values()]))
     try:
-        CURSOR['sage'].execute(READ['IMAGES'], (line, ))
-        images = CURSOR['sage'].fetchall()
+        cursor.execute(READ['IMAGES'], (line, ))
+        images = cursor.fetchall()
     except Exception as err:
         sql_error(err)
+    updates = []
     for image in images:
         LOGGER.info("%s (%s)", image['slide_code'], image['data_set'])
-        update_jacs(image['slide_code'], image['data_set'], None, lineprop[ARG.PROPERTY])
+        updates.append((image['slide_code'], image['data_set'], None, sage_props))
+    return 'lines', updates
 
 
 def process_single_slide_code(slide):
-    """ Update properties for one slide code on JACS
+    """ Get the SAGE properties for one slide code's images
         Keyword arguments:
           slide: slide code
         Returns:
-          None
+          COUNT key, and list of (slide code, data set, cross barcode, properties)
     """
-    READ['IMAGEPROP'] = READ['IMAGEPROP'].replace('!REPLACE!', ARG.PROPERTY)
+    cursor = sage_cursor()
     try:
-
-        CURSOR['sage'].execute(READ['IMAGEPROP'], (slide, ))
-        rows = CURSOR['sage'].fetchall()
+        cursor.execute(READ['IMAGEPROP'], (slide, ))
+        rows = cursor.fetchall()
     except Exception as err:
         sql_error(err)
     if not rows:
         LOGGER.error("%s was not found in SAGE", slide)
-        COUNT['missings'] += 1
-        return
-    COUNT['slide_codes'] += 1
+        return 'missings', []
+    updates = []
     for row in rows:
-        if not row[ARG.PROPERTY]:
-            LOGGER.warning("%s is null for image %s/%s", ARG.PROPERTY, slide, row['data_set'])
-            continue
-        barcode = row['cross_barcode'] if ARG.PROPERTY in CROSSPROPS else None
-        if barcode:
-            LOGGER.info("%s %s (%s)", slide, barcode, row[ARG.PROPERTY])
-        else:
-            LOGGER.info("%s (%s)", slide, row[ARG.PROPERTY])
-        update_jacs(slide, row['data_set'], barcode, row[ARG.PROPERTY])
+        # Cross properties are matched on cross barcode as well
+        by_barcode = dict()
+        for prop in ARG.PROPERTY:
+            if not row[prop]:
+                LOGGER.warning("%s is null for image %s/%s", prop, slide, row['data_set'])
+                continue
+            barcode = row['cross_barcode'] if prop in CROSSPROPS else None
+            by_barcode.setdefault(barcode, dict())[prop] = row[prop]
+        for barcode, sage_props in by_barcode.items():
+            values = ', '.join([str(val) for val in sage_props.values()])
+            if barcode:
+                LOGGER.info("%s %s (%s)", slide, barcode, values)
+            else:
+                LOGGER.info("%s (%s)", slide, values)
+            updates.append((slide, row['data_set'], barcode, sage_props))
+    return 'slide_codes', updates
+
+
+def read_journal():
+    """ Read the last checkpoint from the journal
+        Returns:
+          checkpoint dictionary, or None if there is no checkpoint
+    """
+    checkpoint = None
+    if not path.exists(JOURNAL):
+        return checkpoint
+    with open(JOURNAL) as jfile:
+        for row in jfile:
+            try:
+                checkpoint = json.loads(row)
+            except ValueError:
+                # The last checkpoint was only partly written
+                break
+    return checkpoint
+
+
+def write_checkpoint(done):
+    """ Send queued updates, then record completed items in the journal
+        Keyword arguments:
+          done: number of input items completed
+        Returns:
+          None
+    """
+    flush_updates('sample')
+    flush_updates('image')
+    CHANGES.flush()
+    with open(JOURNAL, 'a') as jfile:
+        jfile.write(json.dumps({'done': done, 'count': COUNT, 'changes': CHANGE_FILE,
+                                'write': ARG.WRITE}) + "\n")
 
 
 def process_lines():
@@ -302,35 +698,98 @@ def process_lines():
         Returns:
           None
     """
-    if ARG.FILE:
+    READ['IMAGEPROP'] = READ['IMAGEPROP'].replace('!REPLACE!', ','.join(ARG.PROPERTY))
+    batch = plan_batch if PLAN else update_jacs_batch
+    if ARG.APPLY:
+        apply_plan()
+    elif ARG.FILE:
         with open(ARG.FILE) as ifile:
             items = ifile.read().splitlines()
         ifile.close()
-        for item in tqdm(items):
-            if PROPSET == 'image':
-                process_single_slide_code(item)
+        if DONE:
+            LOGGER.warning("Resuming after %d of %d items", DONE, len(items))
+        single = process_single_slide_code if PROPSET == 'image' else process_single_line
+        # SAGE is read by --workers threads, and results (and counts) are
+        # used in input order, so checkpoints only count completed items.
+        # JACS documents are fetched for --batch items at a time.
+        executor = ThreadPoolExecutor(max_workers=ARG.WORKERS) if ARG.WORKERS > 1 else None
+        futures = []
+        try:
+            todo = items[DONE:]
+            if executor:
+                futures = [executor.submit(single, item) for item in todo]
+                results = (future.result() for future in futures)
             else:
-                process_single_line(item)
-    elif ARG.LINE:
-        process_single_line(ARG.LINE)
-    elif ARG.SLIDE:
-        process_single_slide_code(ARG.SLIDE)
-    print("Lines found in SAGE:       %d" % (COUNT['lines']))
-    print("Lines missing from SAGE:   %d" % (COUNT['missingl']))
-    print("Slides found in SAGE:      %d" % (COUNT['slide_codes']))
-    print("Slides missing from SAGE:  %d" % (COUNT['missings']))
-    print("Samples found:             %d" % (COUNT['samples']))
-    print("Images found:              %d" % (COUNT['images']))
-    print("Samples missing from JACS: %d" % (COUNT['missingj']))
-    print("Samples missing data:      %d" % (COUNT['noprop']))
+                results = map(single, todo)
+            updates = []
+            for num, (key, result) in enumerate(tqdm(results, total=len(items),
+                                                     initial=DONE), DONE + 1):
+                COUNT[key] += 1
+                updates.extend(result)
+                if not num % ARG.BATCH or num == len(items):
+                    batch(updates)
+                    if JOURNAL:
+                        write_checkpoint(num)
+                    updates = []
+        finally:
+            if executor:
+                # Items that have not started are not read after a failure
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+    elif ARG.LINE or ARG.SLIDE:
+        if ARG.LINE:
+            (key, result) = process_single_line(ARG.LINE)
+        else:
+            (key, result) = process_single_slide_code(ARG.SLIDE)
+        COUNT[key] += 1
+        batch(result)
+    flush_updates('sample')
+    flush_updates('image')
+    if not ARG.APPLY:
+        print("Lines found in SAGE:       %d" % (COUNT['lines']))
+        print("Lines missing from SAGE:   %d" % (COUNT['missingl']))
+        print("Slides found in SAGE:      %d" % (COUNT['slide_codes']))
+        print("Slides missing from SAGE:  %d" % (COUNT['missings']))
+        print("Samples found:             %d" % (COUNT['samples']))
+        # Plans only return mismatched images, and don't check for missing fields
+        if not PLAN:
+            print("Images found:              %d" % (COUNT['images']))
+        print("Samples missing from JACS: %d" % (COUNT['missingj']))
+        if not PLAN:
+            print("Samples missing data:      %d" % (COUNT['noprop']))
     print("Samples needing update:    %d" % (COUNT['samplemm']))
     print("Samples updated:           %d" % (COUNT['sampleup']))
     print("Images needing update:     %d" % (COUNT['imagemm']))
     print("Images updated:            %d" % (COUNT['imageup']))
+    if ARG.APPLY:
+        print("Samples changed since plan: %d" % (COUNT['samplestale']))
+        print("Images changed since plan:  %d" % (COUNT['imagestale']))
     if CHANGES:
         CHANGES.close()
         if not path.getsize(CHANGE_FILE):
             remove(CHANGE_FILE)
+    if JOURNAL and path.exists(JOURNAL):
+        remove(JOURNAL)
+    if PLAN:
+        PLAN.close()
+        print("Change plan written to %s" % (ARG.PLAN))
+
+
+def positive_int(value):
+    """ Parse a count argument that must be at least 1
+        Keyword arguments:
+          value: argument value
+        Returns:
+          integer value
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % (value))
+    return(number)
 
 
 # -----------------------------------------------------------------------------
@@ -338,8 +797,8 @@ def process_lines():
 if __name__ == '__main__':
     PARSER = argparse.ArgumentParser(
         description="Update line property on JACS")
-    PARSER.add_argument('--property', dest='PROPERTY', action='store',
-                        default='flycore_lab', help='Line property')
+    PARSER.add_argument('--property', dest='PROPERTY', action='store', nargs='+',
+                        default=['flycore_lab'], help='Line properties')
     INPUT_GROUP = PARSER.add_mutually_exclusive_group(required=True)
     INPUT_GROUP.add_argument('--line', dest='LINE', action='store',
                              default='', help='Line')
@@ -347,10 +806,21 @@ if __name__ == '__main__':
                              default='', help='Slide code')
     INPUT_GROUP.add_argument('--file', dest='FILE', action='store',
                              default='', help='File containing lines')
+    INPUT_GROUP.add_argument('--apply', dest='APPLY', action='store',
+                             default='', help='Change plan to apply')
+    PARSER.add_argument('--plan', dest='PLAN', action='store', default='',
+                        help='Write a change plan to this file instead of updating')
     PARSER.add_argument('--manifold', dest='MANIFOLD', action='store',
                         choices=['dev', 'prod'], default='dev', help='Manifold')
     PARSER.add_argument('--write', dest='WRITE', action='store_true',
                         default=False, help='Actually write to Mongo')
+    PARSER.add_argument('--batch', dest='BATCH', action='store', type=positive_int,
+                        default=1000,
+                        help='Number of items to look up, or updates to send, at once')
+    PARSER.add_argument('--resume', dest='RESUME', action='store_true',
+                        default=False, help='Resume an interrupted --file run')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        default=1, help='Number of threads to read SAGE with')
     PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
                         default=False, help='Flag, Chatty')
     PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
@@ -368,18 +838,58 @@ if __name__ == '__main__':
     HANDLER.setFormatter(colorlog.ColoredFormatter())
     LOGGER.addHandler(HANDLER)
 
-    initialize_program()
-    if ARG.PROPERTY in PROPMAP['line']:
-        PROPSET = 'line'
-    elif ARG.PROPERTY in PROPMAP['image']:
-        PROPSET = 'image'
-    else:
-        LOGGER.error("Property %s is not mapped to a JACS property name", ARG.PROPERTY)
+    if ARG.PLAN and ARG.APPLY:
+        LOGGER.error("--plan can not be used with --apply")
         sys.exit(-1)
-    LOGGER.info("%s is a %s property", ARG.PROPERTY, PROPSET)
+    initialize_program()
+    if ARG.APPLY:
+        ARG.PROPERTY = read_plan_header()
+    for PROPERTY in ARG.PROPERTY:
+        if PROPERTY in PROPMAP['line']:
+            PSET = 'line'
+        elif PROPERTY in PROPMAP['image']:
+            PSET = 'image'
+        else:
+            LOGGER.error("Property %s is not mapped to a JACS property name", PROPERTY)
+            sys.exit(-1)
+        if PROPSET and PSET != PROPSET:
+            LOGGER.error("Line and image properties can not be updated together")
+            sys.exit(-1)
+        PROPSET = PSET
+        LOGGER.info("%s is a %s property", PROPERTY, PROPSET)
     CHANGES = None
     TIMESTAMP = strftime("%Y%m%dT%H%M%S")
     CHANGE_FILE = '%s_property_changes_%s.txt' % (PROPSET, TIMESTAMP)
-    CHANGES = open(CHANGE_FILE, 'w')
-    process_lines()
+    if ARG.FILE and not ARG.PLAN:
+        # Completed items are recorded in the journal after every batch
+        JOURNAL = '%s_%s.journal' % (path.splitext(path.basename(ARG.FILE))[0],
+                                     '_'.join(ARG.PROPERTY))
+        CHECKPOINT = read_journal() if ARG.RESUME else None
+        if CHECKPOINT:
+            if CHECKPOINT['write'] != ARG.WRITE:
+                LOGGER.error("%s was not written by a run %s --write", JOURNAL,
+                             'with' if ARG.WRITE else 'without')
+                sys.exit(-1)
+            DONE = CHECKPOINT['done']
+            COUNT.update(CHECKPOINT['count'])
+            CHANGE_FILE = CHECKPOINT['changes']
+        else:
+            if ARG.RESUME:
+                LOGGER.warning("No checkpoint found in %s, starting from the beginning",
+                               JOURNAL)
+            if path.exists(JOURNAL):
+                remove(JOURNAL)
+    elif ARG.RESUME:
+        LOGGER.error("--resume can only be used with --file, and not with --plan")
+        sys.exit(-1)
+    if ARG.PLAN:
+        PLAN = open(ARG.PLAN, 'w')
+        PLAN.write(json.dumps({'propset': PROPSET, 'properties': ARG.PROPERTY}) + "\n")
+    CHANGES = open(CHANGE_FILE, 'a')
+    try:
+        process_lines()
+    finally:
+        # Queued updates are still written if processing fails
+        flush_updates('sample')
+        flush_updates('image')
     sys.exit(0)